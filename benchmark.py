@@ -0,0 +1,434 @@
+import json
+import random
+import sys
+import time
+import types
+import click
+import numpy as np
+
+
+from constants import *
+
+
+# Synthetic city: square grid of streets around the AGH campus.
+origin_lon = 19.900
+origin_lat = 50.060
+vertex_spacing_deg = 0.001
+meters_per_deg_lon = 111320. * np.cos(np.radians(origin_lat))
+meters_per_deg_lat = 110540.
+driving_speed_mps = 8.
+
+n_user_trips = 20
+stages = ['new_request', 'suggest_targets', 'pick_parking_areas', 'total']
+percentiles = [50, 95, 99]
+
+table_style = 'pretty'
+
+
+class FakeSumo:
+    """ State behind the fake traci module: vehicle positions, departures and parking occupancy. """
+
+    def __init__(self):
+        self.positions = {}
+        self.departed = []
+        self.parking_counts = {}
+        self.subscribed_parkings = set()
+        self.subscribed_vehicles = set()
+        self.n_calls = 0
+
+
+    def depart(self, vehicles_with_positions):
+        """ Vehicles departing in the next step; those of the previous one have arrived. """
+        self.departed = [vehicle for vehicle, _ in vehicles_with_positions]
+        self.positions = dict(vehicles_with_positions)
+        self.subscribed_vehicles = set()
+
+
+    def modules(self):
+        """ traci, traci.constants and traci.exceptions replacements, as {module name: module}. """
+        constants = types.ModuleType('traci.constants')
+        constants.VAR_POSITION = 0x42
+        constants.VAR_DEPARTED_VEHICLES_IDS = 0x74
+        constants.VAR_ARRIVED_VEHICLES_IDS = 0x7a
+        constants.VAR_PARKING_STARTING_VEHICLES_IDS = 0x6d
+        constants.VAR_STOP_STARTING_VEHICLES_NUMBER = 0x68
+
+        exceptions = types.ModuleType('traci.exceptions')
+        exceptions.TraCIException = type('TraCIException', (Exception,), {})
+        exceptions.FatalTraCIError = type('FatalTraCIError', (Exception,), {})
+
+        traci = types.ModuleType('traci')
+        traci.constants = constants
+        traci.exceptions = exceptions
+        traci.simulation = types.SimpleNamespace(
+            subscribe=self._call(lambda variables: None),
+            getSubscriptionResults=self._call(lambda: {constants.VAR_DEPARTED_VEHICLES_IDS: tuple(self.departed)}),
+            convertGeo=self._call(lambda x, y: (x, y)),
+            getNetBoundary=self._call(lambda: ((0., 0.), (1., 1.)))
+        )
+        traci.vehicle = types.SimpleNamespace(
+            subscribe=self._call(lambda vehicle, variables: self.subscribed_vehicles.add(vehicle)),
+            unsubscribe=self._call(lambda vehicle: self.subscribed_vehicles.discard(vehicle)),
+            getAllSubscriptionResults=self._call(lambda: {vehicle: {constants.VAR_POSITION: self.positions[vehicle]} for vehicle in self.subscribed_vehicles}),
+            getPosition=self._call(lambda vehicle: self.positions[vehicle])
+        )
+        traci.parkingarea = types.SimpleNamespace(
+            subscribe=self._call(lambda parking, variables: self.subscribed_parkings.add(parking)),
+            getAllSubscriptionResults=self._call(lambda: {
+                parking: {constants.VAR_STOP_STARTING_VEHICLES_NUMBER: self.parking_counts.get(parking, 0)} for parking in self.subscribed_parkings
+            })
+        )
+
+        return {'traci': traci, 'traci.constants': constants, 'traci.exceptions': exceptions}
+
+
+    def _call(self, function):
+        def counted(*args):
+            self.n_calls += 1
+            return function(*args)
+        return counted
+
+
+def install_fake_traci(sumo):
+    """ Makes `import traci` return the fake; must happen before importing advisor modules. """
+    sys.modules.update(sumo.modules())
+
+
+class SyntheticCity:
+    """ Road grid, buildings, parking areas, users with calendars and their history, all drawn from one seed. """
+
+    def __init__(self, grid_size, n_buildings, n_parkings, n_users, history_size, calendar_events, seed):
+        rng = np.random.default_rng(seed)
+
+        xs, ys = np.meshgrid(np.arange(grid_size), np.arange(grid_size))
+        self.vertex_ids = np.arange(1, grid_size * grid_size + 1)
+        self.vertex_lon = origin_lon + xs.ravel() * vertex_spacing_deg
+        self.vertex_lat = origin_lat + ys.ravel() * vertex_spacing_deg
+        self.edges = self._grid_edges(grid_size)
+
+        self.buildings = [f'B{i}' for i in range(n_buildings)]
+        self.building_vertices = rng.choice(self.vertex_ids, n_buildings)
+        self.parkings = [f'P{i}' for i in range(n_parkings)]
+        self.parking_vertices = rng.choice(self.vertex_ids, n_parkings)
+        self.parking_capacity = rng.integers(5, 50, n_parkings)
+
+        self.building_xy = self._xy_of(self.building_vertices)
+        self.parking_xy = self._xy_of(self.parking_vertices)
+
+        self.users = self._users(rng, n_users, calendar_events)
+        self.history = self._history(rng, n_users, history_size)
+
+
+    def _grid_edges(self, grid_size):
+        index = np.arange(grid_size * grid_size).reshape(grid_size, grid_size)
+        source = np.concatenate([index[:, :-1].ravel(), index[:-1, :].ravel()])
+        target = np.concatenate([index[:, 1:].ravel(), index[1:, :].ravel()])
+        length = np.concatenate([
+            np.full(grid_size * (grid_size - 1), vertex_spacing_deg * meters_per_deg_lon),
+            np.full(grid_size * (grid_size - 1), vertex_spacing_deg * meters_per_deg_lat)
+        ])
+        cost = length / driving_speed_mps
+        return [self.vertex_ids[source], self.vertex_ids[target], cost, cost, length]
+
+
+    def _xy_of(self, vertices):
+        i = vertices - 1
+        return np.column_stack([self.vertex_lon[i] * meters_per_deg_lon, self.vertex_lat[i] * meters_per_deg_lat])
+
+
+    def _users(self, rng, n_users, calendar_events):
+        from users_model import UsersModel
+
+        calendar_offsets, calendar_times, calendar_places = [0], [], []
+        trip_ids, trip_user, trip_target, trip_time = [], [], [], []
+
+        for user_id in range(n_users):
+            times = np.sort(rng.integers(0, WEEK_LEN_SECONDS, calendar_events))
+            calendar_times.extend(times.tolist())
+            calendar_places.extend(rng.choice(self.buildings, calendar_events).tolist())
+            calendar_offsets.append(len(calendar_times))
+
+            for k in range(n_user_trips):
+                trip_ids.append(f'usr{user_id}_{k}')
+                trip_user.append(user_id)
+                trip_target.append(str(rng.choice(self.buildings)))
+                trip_time.append(int(rng.integers(0, WEEK_LEN_SECONDS)))
+
+        return UsersModel(np.arange(n_users), calendar_offsets, calendar_times, calendar_places, trip_ids, trip_user, trip_target, trip_time)
+
+
+    def _history(self, rng, n_users, history_size):
+        """ user_history rows; every user returns to a handful of favourite buildings at habitual times of week. """
+        rows = []
+        for user_id in range(n_users):
+            favourites = rng.choice(self.buildings, min(5, len(self.buildings)), replace=False)
+            habits = rng.integers(0, WEEK_LEN_SECONDS, len(favourites))
+            for i in range(history_size):
+                k = rng.integers(len(favourites))
+                time_of_week = int(habits[k] + rng.integers(-1800, 1800)) % WEEK_LEN_SECONDS
+                rows.append((str(user_id), str(favourites[k]), time_of_week, i // len(favourites) * WEEK_LEN_SECONDS + time_of_week))
+        return sorted(rows, key=lambda row: (row[0], row[3]))
+
+
+    def parking_registry(self):
+        from parking_registry import ParkingRegistry
+
+        n = len(self.parkings)
+        return ParkingRegistry(
+            self.parkings, [f'e{i}_0' for i in range(n)], self.parking_capacity, np.zeros(n), np.full(n, 50.), np.zeros(n),
+            np.zeros(n + 1, dtype=np.int64), np.empty((0, 4))
+        )
+
+
+    def random_position(self, rng):
+        i = rng.integers(len(self.vertex_ids))
+        return float(self.vertex_lon[i] + rng.normal(0, vertex_spacing_deg / 4)), float(self.vertex_lat[i] + rng.normal(0, vertex_spacing_deg / 4))
+
+
+class StandInDatabase:
+    """ Answers the advisor's and router's registered statements from a SyntheticCity, in process.
+
+    `advisor_nearest_parkings` returns `n_candidates` parking areas nearest to
+    the building regardless of the requested limit, so the candidate count
+    can be varied without changing the advisor.
+    """
+
+    def __init__(self, city, n_candidates):
+        self._city = city
+        self._n_candidates = n_candidates
+        self._building_index = {building: i for i, building in enumerate(city.buildings)}
+        self.n_calls = {}
+
+        self._handlers = {
+            'routing_vertices': lambda: list(zip(city.vertex_ids.tolist(), city.vertex_lon.tolist(), city.vertex_lat.tolist())),
+            'routing_edges': lambda: list(zip(*(np.asarray(column).tolist() for column in city.edges))),
+            'routing_buildings': lambda: list(zip(city.buildings, city.building_vertices.tolist())),
+            'routing_parkings': lambda: list(zip(city.parkings, city.parking_vertices.tolist())),
+            'history_load': lambda: city.history,
+            'advisor_nearby_targets': self._nearby_buildings,
+            'advisor_nearest_parkings': self._nearest_parkings
+        }
+
+
+    def register(self, name, sql, arg_types=()):
+        pass
+
+
+    def fetch_all(self, name, params=()):
+        self.n_calls[name] = self.n_calls.get(name, 0) + 1
+        return self._handlers[name](*params)
+
+
+    def execute(self, name, params=()):
+        self.n_calls[name] = self.n_calls.get(name, 0) + 1
+
+
+    def execute_sql(self, sql, params=None):
+        pass
+
+
+    def _nearby_buildings(self, lon, lat, max_distance):
+        point = np.array([lon * meters_per_deg_lon, lat * meters_per_deg_lat])
+        distances = np.hypot(*(self._city.building_xy - point).T)
+        return [(self._city.buildings[i], float(distances[i])) for i in np.flatnonzero(distances <= max_distance)]
+
+
+    def _nearest_parkings(self, building, limit):
+        distances = np.hypot(*(self._city.parking_xy - self._city.building_xy[self._building_index[building]]).T)
+        n = min(self._n_candidates, len(distances))
+        nearest = np.argpartition(distances, n - 1)[:n]
+        return [(self._city.parkings[i],) for i in nearest[np.argsort(distances[nearest])]]
+
+
+class NullHistoryWriter:
+    def put(self, record):
+        pass
+
+
+    def flush(self):
+        pass
+
+
+    def discard(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+def timed_recommendation(advisor, request, true_target):
+    start = time.perf_counter()
+    advisor.suggest_targets(request)
+    suggested = time.perf_counter()
+    advisor.pick_parking_areas(request, true_target)
+    picked = time.perf_counter()
+    return suggested - start, picked - suggested
+
+
+def run_benchmark(city, sumo, advisor, occupancy, vehicle_states, time_controller, n_requests, warmup, threads, seed):
+    """ Activates the advisor for n_requests departures (after `warmup` unmeasured ones), `threads` departures per step. """
+    from concurrent.futures import ThreadPoolExecutor
+
+    rng = np.random.default_rng(seed + 1)
+    trips = city.users.trip_ids
+    timings = {stage: [] for stage in stages}
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    sim_time = 0.
+    measured_wall_time = 0.
+    n_done = 0
+    while n_done < warmup + n_requests:
+        departing = [trips[i] for i in rng.integers(len(trips), size=min(threads, warmup + n_requests - n_done))]
+        sumo.depart([(vehicle, city.random_position(rng)) for vehicle in departing])
+        for parking, capacity in zip(city.parkings, city.parking_capacity.tolist()):
+            sumo.parking_counts[parking] = int(rng.integers(0, capacity + 1))
+
+        sim_time += 60.
+        step_start = time.perf_counter()
+        time_controller.update_curr_time(sim_time)
+        occupancy.update()
+        vehicle_states.update()
+
+        requests, request_times = [], []
+        for vehicle in vehicle_states.departed_guided:
+            start = time.perf_counter()
+            requests.append(advisor.new_request(vehicle))
+            request_times.append(time.perf_counter() - start)
+        true_targets = [city.users.target_of(request.vehicle) for request in requests]
+
+        if executor is not None:
+            stage_times = list(executor.map(timed_recommendation, [advisor] * len(requests), requests, true_targets))
+        else:
+            stage_times = [timed_recommendation(advisor, request, true_target) for request, true_target in zip(requests, true_targets)]
+        step_time = time.perf_counter() - step_start
+
+        if n_done >= warmup:
+            measured_wall_time += step_time
+            for request_time, (suggest_time, pick_time) in zip(request_times, stage_times):
+                timings['new_request'].append(request_time)
+                timings['suggest_targets'].append(suggest_time)
+                timings['pick_parking_areas'].append(pick_time)
+                timings['total'].append(request_time + suggest_time + pick_time)
+        n_done += len(requests)
+
+    if executor is not None:
+        executor.shutdown()
+    return timings, measured_wall_time
+
+
+def summarize(timings, wall_time):
+    """ Latency percentiles [ms] and throughput [1/s] of every stage; total throughput uses wall time, so it includes concurrency. """
+    summary = {}
+    for stage in stages:
+        values = np.asarray(timings[stage])
+        summary[stage] = {f'p{p}': float(np.percentile(values, p)) * 1000. for p in percentiles}
+        summary[stage]['mean'] = float(values.mean()) * 1000.
+        summary[stage]['throughput'] = len(values) / wall_time if stage == 'total' else 1. / float(values.mean())
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    """ Rows of (stage, metric, baseline, current, ratio, verdict); latency may grow and throughput drop by `tolerance`. """
+    rows = []
+    for stage in stages:
+        for metric in [f'p{p}' for p in percentiles] + ['throughput']:
+            old, new = baseline['stages'][stage][metric], summary[stage][metric]
+            ratio = new / old if old else float('inf')
+            regressed = ratio < 1 - tolerance if metric == 'throughput' else ratio > 1 + tolerance
+            rows.append((stage, metric, round(old, 3), round(new, 3), round(ratio, 3), 'REGRESSION' if regressed else 'ok'))
+    return rows
+
+
+def print_summary(summary):
+    from tabulate import tabulate
+
+    headers = ['Stage', *[f'p{p} [ms]' for p in percentiles], 'Mean [ms]', 'Throughput [1/s]']
+    table = [[stage, *[round(summary[stage][f'p{p}'], 3) for p in percentiles], round(summary[stage]['mean'], 3), round(summary[stage]['throughput'], 1)] for stage in stages]
+    print(tabulate(table, headers=headers, tablefmt=table_style))
+
+
+@click.command()
+@click.option('--users', 'n_users', default=100, show_default=True, help='Number of synthetic users.')
+@click.option('--buildings', 'n_buildings', default=60, show_default=True, help='Number of buildings.')
+@click.option('--parkings', 'n_parkings', default=120, show_default=True, help='Number of parking areas.')
+@click.option('--grid', 'grid_size', default=40, show_default=True, help='Road network is a grid of grid x grid intersections.')
+@click.option('--history-size', default=100, show_default=True, help='Stored history records per user.')
+@click.option('--calendar-events', default=12, show_default=True, help='Calendar events per user.')
+@click.option('--candidates', 'n_candidates', default=10, show_default=True, help='Parking areas considered for every target.')
+@click.option('-n', '--requests', 'n_requests', default=1000, show_default=True, help='Number of measured activations.')
+@click.option('--warmup', default=50, show_default=True, help='Number of activations before measuring.')
+@click.option('--threads', default=1, type=click.IntRange(min=1), show_default=True, help='Departures per step, served concurrently.')
+@click.option('--seed', default=0, show_default=True, help='Seed of the synthetic city and of departures.')
+@click.option('--save-baseline', default='', help='File to which results should be saved as baseline.')
+@click.option('--compare', 'baseline_file', default='', help='Baseline file to compare results with; exits with 1 on regression.')
+@click.option('--tolerance', default=0.1, show_default=True, help='Relative change tolerated before reporting regression.')
+@click.option('--instrument', default=False, is_flag=True, help='Also print timers and counters of the advisor internal stages.')
+def main(n_users, n_buildings, n_parkings, grid_size, history_size, calendar_events, n_candidates, n_requests, warmup, threads, seed, save_baseline, baseline_file, tolerance, instrument):
+    config = {
+        'users': n_users, 'buildings': n_buildings, 'parkings': n_parkings, 'grid': grid_size, 'history_size': history_size,
+        'calendar_events': calendar_events, 'candidates': n_candidates, 'requests': n_requests, 'threads': threads, 'seed': seed
+    }
+
+    sumo = FakeSumo()
+    install_fake_traci(sumo)
+
+    from parking_advisor import ParkingAdvisor
+    from occupancy import OccupancyTracker
+    from vehicle_state import VehicleStates
+    from time_controller import TimeController
+    from environment import Environment
+    from routing import RoadGraph
+    from walking_matrix import WalkingTimeMatrix
+
+    random.seed(seed)
+    city = SyntheticCity(grid_size, n_buildings, n_parkings, n_users, history_size, calendar_events, seed)
+    db = StandInDatabase(city, n_candidates)
+    parkings = city.parking_registry()
+
+    router = RoadGraph.load(db)
+    walking_times = WalkingTimeMatrix.build(router, city.buildings, city.parkings, 'benchmark')
+    time_controller = TimeController(False, 1, 1, '08:00:00')
+    occupancy = OccupancyTracker(parkings)
+    vehicle_states = VehicleStates(city.users.trip_ids)
+    advisor = ParkingAdvisor(
+        time_controller, Environment(0.5, 0.5), parkings, occupancy, vehicle_states, city.users,
+        db=db, walking_times=walking_times, history_writer=NullHistoryWriter()
+    )
+
+    if instrument:
+        from instrumentation import instruments
+        instruments.enable()
+
+    timings, wall_time = run_benchmark(city, sumo, advisor, occupancy, vehicle_states, time_controller, n_requests, warmup, threads, seed)
+    summary = summarize(timings, wall_time)
+    print_summary(summary)
+
+    if instrument:
+        from main import log_instrumentation_summary
+        from logger import Logger
+
+        logger = Logger(False, '')
+        log_instrumentation_summary(logger)
+        logger.close()
+
+    if save_baseline:
+        with open(save_baseline, 'w') as out:
+            json.dump({'config': config, 'stages': summary}, out, indent=4)
+
+    if baseline_file:
+        from tabulate import tabulate
+
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print(f'WARNING: baseline was measured with different configuration: {baseline["config"]}')
+
+        rows = compare(summary, baseline, tolerance)
+        print(tabulate(rows, headers=['Stage', 'Metric', 'Baseline', 'Current', 'Ratio', 'Verdict'], tablefmt=table_style))
+        if any(row[-1] == 'REGRESSION' for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,3 @@
 pipenv run python load_buildings.py
-pipenv run python generate_parkings.py load
\ No newline at end of file
+pipenv run python generate_parkings.py load
+pipenv run python walking_matrix.py
\ No newline at end of file
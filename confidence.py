@@ -0,0 +1,101 @@
+import numpy as np
+
+
+from constants import *
+
+
+COMPONENTS = ['nearby', 'calendar', 'frequent', 'repeating']
+
+
+def gaussian(x, mean=0.0, sd=max(POS_TIME_DELTA_SEC, NEG_TIME_DELTA_SEC) / 3):
+    var = float(sd)**2
+    denom = (2*np.pi*var)**.5
+    num = np.exp(-(np.asarray(x, dtype=np.float64)-float(mean))**2/(2*var))
+    return num/denom * 3000
+
+
+def time_of_week_delta(a, b):
+    """ Signed difference a - b between times of week, wrapped around the end of the week into [-W/2, W/2). """
+    return (np.asarray(a, dtype=np.float64) - b + WEEK_LEN_SECONDS / 2) % WEEK_LEN_SECONDS - WEEK_LEN_SECONDS / 2
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-np.asarray(x, dtype=np.float64)*4 + 4))
+
+
+def sigmoid_star(x):
+    return 2 / (1 + np.exp(np.asarray(x, dtype=np.float64) / (FREQ_N * WEEK_LEN_SECONDS)))
+
+
+class ConfidenceScores:
+    """ Confidence of every candidate target, split into components (a targets x COMPONENTS matrix). """
+
+    def __init__(self, targets, matrix):
+        self._targets = list(targets)
+        self._index = {target: i for i, target in enumerate(self._targets)}
+        self.matrix = matrix
+
+
+    def ordered_targets(self):
+        """ Targets from the most to the least probable one. """
+        order = np.argsort(-self.matrix.sum(axis=1), kind='stable')
+        return [self._targets[i] for i in order]
+
+
+    def components(self, target):
+        row = self.matrix[self._index[target]] if target in self._index else _empty_row()
+        return {component: float(value) for component, value in zip(COMPONENTS, row)}
+
+
+def _empty_row():
+    """ Components of a target which appears in none of the target sets. """
+    return np.array([0., 0., BASE_CONF_FREQUENT * sigmoid(0.), BASE_CONF_REPEATING * sigmoid(0.)])
+
+
+def score_targets(target_sets, eta_time_of_week, curr_global_time):
+    """ Scores all targets from target_sets at once.
+
+    `eta_time_of_week` maps every target having calendar or repeating entries
+    to its expected arrival time of week.
+    """
+    nearby = target_sets['nearby_targets']
+    calendar = target_sets['calendar_targets']
+    frequent = target_sets['frequent_targets']
+    repeating = target_sets['repeating_targets']
+
+    targets = sorted(set(nearby) | {t[0] for t in calendar} | {t[0] for t in frequent} | {t[0] for t in repeating})
+    index = {target: i for i, target in enumerate(targets)}
+    n = len(targets)
+    matrix = np.zeros((n, len(COMPONENTS)))
+
+    if nearby:
+        rows = np.array([index[target] for target in nearby], dtype=np.int64)
+        distances = np.array(list(nearby.values()), dtype=np.float64)
+        matrix[rows, 0] = BASE_CONF_NEARBY * (1. - distances / MAX_DIST_NEARBY_METERS)
+
+    if calendar:
+        rows, times_of_week = _columns(calendar, index)
+        etas = np.array([eta_time_of_week[targets[i]] for i in rows], dtype=np.float64)
+        matrix[:, 1] = np.bincount(rows, weights=BASE_CONF_CALENDAR * gaussian(time_of_week_delta(etas, times_of_week)), minlength=n)
+
+    frequent_sums = np.zeros(n)
+    if frequent:
+        rows, absolute_times = _columns(frequent, index)
+        frequent_sums = np.bincount(rows, weights=sigmoid_star(curr_global_time - absolute_times), minlength=n)
+    matrix[:, 2] = BASE_CONF_FREQUENT * sigmoid(frequent_sums)
+
+    repeating_sums = np.zeros(n)
+    if repeating:
+        rows, times_of_week, absolute_times = _columns(repeating, index)
+        etas = np.array([eta_time_of_week[targets[i]] for i in rows], dtype=np.float64)
+        repeating_sums = np.bincount(rows, weights=np.sqrt(sigmoid_star(curr_global_time - absolute_times) * gaussian(time_of_week_delta(etas, times_of_week))), minlength=n)
+    matrix[:, 3] = BASE_CONF_REPEATING * sigmoid(repeating_sums)
+
+    return ConfidenceScores(targets, matrix)
+
+
+def _columns(entries, index):
+    """ Splits (target, value, ...) tuples into target index array and value arrays. """
+    rows = np.array([index[entry[0]] for entry in entries], dtype=np.int64)
+    values = [np.array([entry[k] for entry in entries], dtype=np.float64) for k in range(1, len(entries[0]))]
+    return (rows, *values)
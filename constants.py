@@ -21,11 +21,14 @@ MAX_TIME_WALKING = 900
 MAX_TIME_DRIVING = 1200
 
 COEF_FREE_SPACE = 2
+WALKING_SPEED_MPS = 1.5
 FREQ_N = 5
 
 MIN_STOP_TIME_SEC = 200
 MAX_STOP_TIME_SEC = 2000
 
+WEIGHTS_RELOAD_INTERVAL_SEC = 1.0
+
 
 # ====================================================================
 # Technical constants:
@@ -37,6 +40,8 @@ WEEK_LEN_SECONDS = 7 * DAY_LEN_SECONDS
 
 DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 
+TRIP_SORT_CHUNK_SIZE = 100000
+
 
 # ====================================================================
 # File and directory names:
@@ -55,9 +60,23 @@ net_gen_filename = 'osm.net.xml'
 users_trips_filename = 'users.trips.xml'
 all_trips_gen_filename = 'agh.random.trips.xml'
 buildings_filename = 'buildings.xml'
+walking_times_gen_filename = 'walking_times.npz'
+snapshot_gen_suffix = '.snapshot.npz'
 map_filename = 'agh_bbox.osm.xml'
 
 
 # ====================================================================
 # Database:
 conn_string = "dbname=agh user=postgres password=letMEin!"
+DB_POOL_MAX_CONN = 8
+DB_POOL_MIN_CONN = 2   # opened at startup and kept open; connections above it are closed when returned
+HISTORY_BATCH_SIZE = 50
+HISTORY_FLUSH_INTERVAL_SEC = 5.0
+DB_SLOW_QUERY_SEC = 0.05
+DB_MAX_PLANS_PER_FUNCTION = 3
+
+
+# ====================================================================
+# Logging:
+LOG_BATCH_SIZE = 200
+LOG_FLUSH_INTERVAL_SEC = 0.5
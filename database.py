@@ -0,0 +1,212 @@
+from contextlib import contextmanager
+import threading
+import time
+import weakref
+from psycopg2 import errors, extensions, extras, pool
+
+
+from instrumentation import instruments
+from constants import *
+
+
+class Database:
+    """ Pool of warm connections shared by the advisor and the generators.
+
+    Queries used on hot paths are registered once by name and executed as
+    server-side prepared statements, prepared lazily on every pooled connection.
+    Names prepared on a connection are remembered per connection object, so a
+    closed connection takes its entry with it. Only `min_connections` are
+    opened up front and kept open; the pool grows up to `max_connections`
+    under load, closing the extra ones as they are returned.
+    With `schema` given, it is searched before public, so its tables (e.g. a
+    private user_history) shadow the shared ones. With `tracer` given (see
+    query_tracer.QueryTracer), every executed statement is reported to it.
+    """
+
+    def __init__(self, dsn=conn_string, min_connections=DB_POOL_MIN_CONN, max_connections=DB_POOL_MAX_CONN, schema=None, tracer=None):
+        connect_options = {'options': f'-c search_path={schema},public'} if schema else {}
+        self._pool = pool.ThreadedConnectionPool(min(min_connections, max_connections), max_connections, dsn, **connect_options)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._tracer = tracer
+
+        self._statements = {}
+        self._prepared = weakref.WeakKeyDictionary()
+
+        self._n_checkouts = 0
+        self._wait_time_total = 0.
+        self._wait_time_max = 0.
+
+
+    def register(self, name, sql, arg_types=()):
+        """ Registers named statement; sql refers to arguments as $1, $2, ... """
+        self._statements[name] = (sql, tuple(arg_types))
+
+
+    @contextmanager
+    def connection(self):
+        """ Checks connection out of the pool, commits on success and rolls back on error. """
+        wait_start = time.perf_counter()
+        self._slots.acquire()
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        self._record_wait(time.perf_counter() - wait_start)
+
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            broken = conn.closed != 0
+            if not broken:
+                conn.rollback()
+            raise
+        finally:
+            if broken:
+                with self._lock:
+                    self._prepared.pop(conn, None)
+            self._pool.putconn(conn, close=broken)
+            self._slots.release()
+
+
+    def fetch_all(self, name, params=()):
+        """ Executes registered statement and returns all resulting rows. """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self.execute_prepared(cur, name, params)
+                return cur.fetchall()
+
+
+    def execute(self, name, params=()):
+        """ Executes registered statement which returns no rows. """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self.execute_prepared(cur, name, params)
+
+
+    def execute_many(self, name, params_list):
+        """ Executes registered statement once for every tuple of params, in a single transaction. """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                for params in params_list:
+                    self.execute_prepared(cur, name, params)
+
+
+    def execute_sql(self, sql, params=None):
+        """ Executes ad-hoc statement (psycopg2 placeholders) in its own transaction. """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self.execute_sql_on(cur, sql, params)
+
+
+    def execute_sql_on(self, cur, sql, params=None, statement='ad_hoc'):
+        """ Executes ad-hoc statement (psycopg2 placeholders) on given cursor, within the caller's transaction. """
+        instruments.count('db.statements')
+        start = time.perf_counter()
+        cur.execute(sql, params)
+        if self._tracer is not None:
+            self._tracer.trace(cur, statement, sql, params, time.perf_counter() - start, f'EXPLAIN (ANALYZE, BUFFERS) {sql}')
+
+
+    def execute_values(self, cur, sql, rows, statement='ad_hoc'):
+        """ Inserts rows with a single multi-row statement (sql has one %s for VALUES), within the caller's transaction. """
+        if not rows:
+            return
+
+        instruments.count('db.statements')
+        start = time.perf_counter()
+        extras.execute_values(cur, sql, rows, page_size=len(rows))
+        if self._tracer is not None:
+            # Rows are already inlined in cur.query, so the plan is captured for exactly this statement.
+            self._tracer.trace(cur, statement, sql, None, time.perf_counter() - start, f'EXPLAIN (ANALYZE, BUFFERS) {cur.query.decode()}')
+
+
+    def execute_prepared(self, cur, name, params=()):
+        """ Executes registered statement on given cursor, within the caller's transaction. """
+        conn = cur.connection
+        sql, arg_types = self._statements[name]
+
+        with self._lock:
+            prepared_on_conn = self._prepared.setdefault(conn, set())
+            needs_preparing = name not in prepared_on_conn
+
+        if needs_preparing:
+            self._prepare(cur, name, sql, arg_types, prepared_on_conn)
+
+        instruments.count('db.statements')
+        args_clause = f' ({", ".join(["%s"] * len(params))})' if params else ''
+        starts_transaction = conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+        start = time.perf_counter()
+        try:
+            cur.execute(f'EXECUTE {name}{args_clause}', tuple(params))
+        except errors.InvalidSqlStatementName:
+            # Server forgot statements of this session (e.g. after DISCARD ALL): prepare them again on next use.
+            # Retried right away only if nothing of the caller's transaction was lost with the failed EXECUTE.
+            with self._lock:
+                prepared_on_conn.clear()
+            if not starts_transaction:
+                raise
+            conn.rollback()
+            self._prepare(cur, name, sql, arg_types, prepared_on_conn)
+            start = time.perf_counter()
+            cur.execute(f'EXECUTE {name}{args_clause}', tuple(params))
+        if self._tracer is not None:
+            self._tracer.trace(cur, name, sql, tuple(params), time.perf_counter() - start, f'EXPLAIN (ANALYZE, BUFFERS) EXECUTE {name}{args_clause}')
+
+
+    def wait_stats(self):
+        """ Time spent waiting for a free connection, in seconds. """
+        with self._lock:
+            return {
+                'checkouts': self._n_checkouts,
+                'total_wait': self._wait_time_total,
+                'mean_wait': self._wait_time_total / self._n_checkouts if self._n_checkouts else 0.,
+                'max_wait': self._wait_time_max
+            }
+
+
+    def close(self):
+        self._pool.closeall()
+        with self._lock:
+            self._prepared = weakref.WeakKeyDictionary()
+
+
+    def _prepare(self, cur, name, sql, arg_types, prepared_on_conn):
+        types_clause = f' ({", ".join(arg_types)})' if arg_types else ''
+        cur.execute(f'PREPARE {name}{types_clause} AS {sql}')
+        with self._lock:
+            prepared_on_conn.add(name)
+        instruments.count('db.prepares')
+
+
+    def _record_wait(self, wait_time):
+        instruments.observe('db.pool_wait', wait_time)
+        with self._lock:
+            self._n_checkouts += 1
+            self._wait_time_total += wait_time
+            self._wait_time_max = max(self._wait_time_max, wait_time)
+
+
+_shared_database = None
+_shared_database_options = {}
+_shared_database_lock = threading.Lock()
+
+
+def shared_database():
+    """ Process-wide database pool, created on first use. """
+    global _shared_database
+    with _shared_database_lock:
+        if _shared_database is None:
+            _shared_database = Database(**_shared_database_options)
+        return _shared_database
+
+
+def configure_shared_database(**options):
+    """ Sets Database arguments of the shared pool; has to be called before its first use. """
+    with _shared_database_lock:
+        if _shared_database is not None:
+            raise RuntimeError('shared database is already in use')
+        _shared_database_options.update(options)
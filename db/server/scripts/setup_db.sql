@@ -29,13 +29,14 @@ create table ways(
     the_geom geometry(LineString,4326)
 );
 
-create table parkings(id varchar(50) primary key, road_id);
+create table parkings(id varchar(50) primary key, road_id bigint, vertex_id bigint);
 
 create table buildings(
     name varchar(10) primary key, 
     lon float, 
     lat float, 
-    geom geometry generated always as (ST_TRANSFORM(ST_SetSRID(ST_Point(lon, lat), 4326), 2178)) stored
+    geom geometry generated always as (ST_TRANSFORM(ST_SetSRID(ST_Point(lon, lat), 4326), 2178)) stored,
+    vertex_id bigint
 );
 
 create table user_history(
@@ -46,6 +47,8 @@ create table user_history(
     primary key (user_id, absolute_time)
 );
 
+create index user_history_time_of_week_idx on user_history(user_id, time_of_week);
+
 
 create or replace function get_parkings_around_point(target_point geometry, n int)
 returns table(
@@ -112,12 +115,25 @@ language plpgsql
 as $$
 begin
     return query
+    with expected_arrivals as (
+        select b.building, curr_time_of_week + estimated_travel_time(b.building, lon, lat) + t_const as eta_time_of_week
+        from (
+            select distinct h.building 
+            from user_history h 
+            where h.user_id = sought_user_id
+        ) b
+    )
     select uh.building, uh.absolute_time, uh.time_of_week
-    from user_history uh
-    where 
-        uh.user_id = sought_user_id 
-        and curr_time_of_week + estimated_travel_time(uh.building, lon, lat) + t_const - uh.time_of_week < neg_time_delta
-        and uh.time_of_week - (curr_time_of_week + estimated_travel_time(uh.building, lon, lat) + t_const) < pos_time_delta;
+    from expected_arrivals e
+        join lateral (
+            select h.building, h.absolute_time, h.time_of_week
+            from user_history h
+            where 
+                h.user_id = sought_user_id
+                and h.time_of_week > e.eta_time_of_week - neg_time_delta
+                and h.time_of_week < e.eta_time_of_week + pos_time_delta
+                and h.building = e.building
+        ) uh on true;
 end; $$;
 
 
@@ -139,30 +155,75 @@ begin
     select name, ST_Distance(loc, geom) as distance from buildings where ST_DWithin(loc, geom, max_dist);
 end; $$;
 
+create or replace function snap_static_points()
+returns void
+language plpgsql
+as $$
+begin
+    update buildings b
+    set vertex_id = (
+        select v.id
+        from ways_vertices_pgr v
+        order by ST_Transform(b.geom, 4326) <-> v.the_geom
+        limit 1);
+
+    update parkings p
+    set vertex_id = (
+        select v.id
+        from ways_vertices_pgr v
+        order by (select w.the_geom from ways w where w.osm_id = p.road_id limit 1) <-> v.the_geom
+        limit 1);
+end; $$;
+
+
+create or replace function building_vertex(building varchar(10))
+returns bigint
+language plpgsql
+as $$
+begin
+    return (
+        select coalesce(b.vertex_id, (
+            select v.id
+            from ways_vertices_pgr v
+            order by ST_Transform(b.geom, 4326) <-> v.the_geom
+            limit 1))
+        from buildings b
+        where b.name = building);
+end; $$;
+
+
+create or replace function parking_vertex(parking varchar(50))
+returns bigint
+language plpgsql
+as $$
+begin
+    return (
+        select coalesce(p.vertex_id, (
+            select v.id
+            from ways_vertices_pgr v
+            order by (select w.the_geom from ways w where w.osm_id = p.road_id limit 1) <-> v.the_geom
+            limit 1))
+        from parkings p
+        where p.id = parking);
+end; $$;
+
+
 create or replace function estimated_travel_time(building varchar(10), lon float, lat float)
 returns integer
 language plpgsql
 as $$
 declare
     loc geometry = ST_SetSRID(ST_Point(lon, lat), 4326);
-    building_loc geometry;
     vertex_near_loc int;
     vertex_near_building int;
     estimated_time float;
 begin
-    select ST_Transform(geom, 4326) into building_loc
-    from buildings 
-    where name = building;
-
     select id into vertex_near_loc
     from ways_vertices_pgr 
     order by loc <-> the_geom 
     limit 1;
 
-    select id into vertex_near_building
-    from ways_vertices_pgr
-    order by building_loc <-> the_geom 
-    limit 1;
+    vertex_near_building := building_vertex(building);
 
     select agg_cost into estimated_time
     from pgr_dijkstraCost(
@@ -178,25 +239,16 @@ language plpgsql
 as $$
 declare
     loc geometry = ST_SetSRID(ST_Point(lon, lat), 4326);
-    parking_loc geometry;
     vertex_near_loc int;
     vertex_near_parking int;
     estimated_time float;
 begin
-    select ST_Transform(w.the_geom, 4326) into parking_loc
-    from parkings p
-        join ways w on p.road_id = w.osm_id 
-    where p.id = parking;
-
     select id into vertex_near_loc
     from ways_vertices_pgr 
     order by loc <-> the_geom 
     limit 1;
 
-    select id into vertex_near_parking
-    from ways_vertices_pgr
-    order by parking_loc <-> the_geom 
-    limit 1;
+    vertex_near_parking := parking_vertex(parking);
 
     select agg_cost into estimated_time
     from pgr_dijkstraCost(
@@ -211,30 +263,13 @@ returns integer
 language plpgsql
 as $$
 declare
-    building_loc geometry;
-    parking_loc geometry;
     vertex_near_building int;
     vertex_near_parking int;
     estimated_time float;
 begin
-    select ST_Transform(w.the_geom, 4326) into parking_loc
-    from parkings p
-        join ways w on p.road_id = w.osm_id 
-    where p.id = parking;
+    vertex_near_building := building_vertex(building);
 
-    select ST_Transform(geom, 4326) into building_loc
-    from buildings 
-    where name = building;
-
-    select id into vertex_near_building
-    from ways_vertices_pgr 
-    order by building_loc <-> the_geom 
-    limit 1;
-
-    select id into vertex_near_parking
-    from ways_vertices_pgr
-    order by parking_loc <-> the_geom 
-    limit 1;
+    vertex_near_parking := parking_vertex(parking);
 
     select agg_cost into estimated_time
     from pgr_dijkstraCost(
@@ -0,0 +1,236 @@
+import itertools
+import json
+import os
+import queue
+import subprocess
+import sys
+import click
+
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+main_script = os.path.join(repo_dir, 'main.py')
+
+history_schema_prefix = 'experiment_worker_'
+# Connections of every simulation process (advisor thread and history writer).
+worker_db_connections = 2
+
+table_style = 'pretty'
+
+
+class RunConfig:
+    """ Single point of the parameter grid, passed to main.py as options. """
+
+    __slots__ = ('index', 'weather', 'air_quality', 'week', 'day', 'time', 'seed')
+
+    def __init__(self, index, weather, air_quality, week, day, time, seed):
+        self.index = index
+        self.weather = weather
+        self.air_quality = air_quality
+        self.week = week
+        self.day = day
+        self.time = time
+        self.seed = seed
+
+
+    @property
+    def name(self):
+        return f'run{self.index:03d}'
+
+
+    def as_dict(self):
+        return {'run': self.name, 'weather': self.weather, 'air_quality': self.air_quality, 'week': self.week, 'day': self.day, 'time': self.time, 'seed': self.seed}
+
+
+    def main_options(self):
+        return [
+            '--weather', str(self.weather), '--air-quality', str(self.air_quality),
+            '-w', str(self.week), '-d', str(self.day), '-t', self.time, '--seed', str(self.seed)
+        ]
+
+
+def parameter_grid(weathers, air_qualities, weeks, days, times, seeds):
+    return [RunConfig(i, *values) for i, values in enumerate(itertools.product(weathers, air_qualities, weeks, days, times, seeds))]
+
+
+def prepare_history_schema(schema, copy_history):
+    """ Creates (or empties) private user_history of a worker, optionally filled with the shared one.
+
+    Uses a connection of its own, closed right away, so the runner holds no
+    connection while the simulations (each with its own pool) are running.
+    """
+    import psycopg2
+    from psycopg2 import sql
+    from database import Database
+
+    table = sql.SQL('{}.user_history').format(sql.Identifier(schema))
+    db = None
+    try:
+        db = Database(min_connections=1, max_connections=1)
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL('create schema if not exists {}').format(sql.Identifier(schema)))
+                cur.execute(sql.SQL('create table if not exists {} (like public.user_history including all)').format(table))
+                cur.execute(sql.SQL('truncate {}').format(table))
+                if copy_history:
+                    cur.execute(sql.SQL('insert into {} select * from public.user_history').format(table))
+        return True
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return False
+    finally:
+        if db is not None:
+            db.close()
+
+
+def run_worker(config, slot, base_port, output_dir, copy_history):
+    """ Runs headless simulation for one configuration; returns path of its JSON-lines log, or None if it failed. """
+    schema = f'{history_schema_prefix}{slot}'
+    json_log = os.path.join(output_dir, f'{config.name}.jsonl')
+    console_log = os.path.join(output_dir, f'{config.name}.out')
+
+    if not prepare_history_schema(schema, copy_history):
+        return None
+    if os.path.exists(json_log):
+        os.remove(json_log)
+
+    cmd = [
+        sys.executable, main_script, '--headless', '-q', '--json-log', json_log,
+        '--label', config.name, '--traci-port', str(base_port + slot), '--db-schema', schema, '--db-connections', str(worker_db_connections),
+        *config.main_options()
+    ]
+    with open(console_log, 'w') as out:
+        return_code = subprocess.run(cmd, cwd=repo_dir, stdout=out, stderr=subprocess.STDOUT).returncode
+
+    return json_log if return_code == 0 and run_completed(json_log) else None
+
+
+def run_completed(json_log):
+    """ Whether JSON-lines log of a run exists and ends the run with the run_end event. """
+    if not os.path.exists(json_log):
+        return False
+    with open(json_log) as f:
+        for line in f:
+            try:
+                if json.loads(line)['event'] == 'run_end':
+                    return True
+            except (ValueError, KeyError):
+                # Last line of a killed run may be cut off.
+                continue
+    return False
+
+
+def read_outcomes(json_log):
+    """ Ranks of true targets among suggestions, cost rows of assigned parking areas and number of failed assignments. """
+    ranks, assigned, n_failed = [], [], 0
+    costs = {}
+
+    with open(json_log) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['event'] == 'suggestions':
+                ranks.append(record['rank'])
+            elif record['event'] == 'costs':
+                costs[record['vehicle']] = {row['parking_area']: row for row in record['costs']}
+            elif record['event'] == 'assignment':
+                if record['parking_area'] is None:
+                    n_failed += 1
+                else:
+                    assigned.append(costs[record['vehicle']][record['parking_area']])
+
+    return ranks, assigned, n_failed
+
+
+def summarize(ranks, assigned, n_failed):
+    mean = lambda values: sum(values) / len(values) if values else None
+    ratio = lambda count: count / len(ranks) if ranks else None
+    suggested_ranks = [rank for rank in ranks if rank is not None]
+
+    return {
+        'guided': len(ranks),
+        'top1': ratio(sum(1 for rank in suggested_ranks if rank == 1)),
+        'top3': ratio(sum(1 for rank in suggested_ranks if rank <= 3)),
+        'not_suggested': ratio(len(ranks) - len(suggested_ranks)),
+        'mean_rank': mean(suggested_ranks),
+        'failed': n_failed,
+        'mean_cost': mean([row['cost'] for row in assigned]),
+        'mean_time_total': mean([row['time_total'] for row in assigned]),
+        'mean_time_walking': mean([row['time_walking'] for row in assigned]),
+        'mean_prob_of_success': mean([row['prob_of_success'] for row in assigned])
+    }
+
+
+def run_experiments(configs, n_processes, base_port, output_dir, copy_history):
+    """ Runs every configuration, at most n_processes at a time, each with its own port, label and history schema. """
+    from concurrent.futures import ThreadPoolExecutor
+
+    free_slots = queue.Queue()
+    for slot in range(n_processes):
+        free_slots.put(slot)
+
+    def run(config):
+        slot = free_slots.get()
+        try:
+            print(f'{config.name}: started (worker {slot})')
+            json_log = run_worker(config, slot, base_port, output_dir, copy_history)
+            print(f'{config.name}: {"finished" if json_log else "FAILED"}')
+            return json_log
+        finally:
+            free_slots.put(slot)
+
+    with ThreadPoolExecutor(max_workers=n_processes) as executor:
+        return list(executor.map(run, configs))
+
+
+def build_report(configs, json_logs):
+    runs = []
+    all_outcomes = ([], [], 0)
+
+    for config, json_log in zip(configs, json_logs):
+        if json_log is None:
+            runs.append({**config.as_dict(), 'status': 'failed'})
+            continue
+
+        outcomes = read_outcomes(json_log)
+        all_outcomes = (all_outcomes[0] + outcomes[0], all_outcomes[1] + outcomes[1], all_outcomes[2] + outcomes[2])
+        runs.append({**config.as_dict(), 'status': 'ok', **summarize(*outcomes)})
+
+    return {'runs': runs, 'overall': summarize(*all_outcomes)}
+
+
+def print_report(report):
+    from tabulate import tabulate
+
+    metrics = ['guided', 'top1', 'top3', 'not_suggested', 'mean_rank', 'failed', 'mean_cost', 'mean_time_total', 'mean_time_walking', 'mean_prob_of_success']
+    headers = ['run', 'weather', 'air_quality', 'week', 'day', 'time', 'seed', 'status', *metrics]
+
+    rounded = lambda value: round(value, 3) if isinstance(value, float) else value
+    table = [[rounded(run.get(header)) for header in headers] for run in report['runs']]
+    table.append(['overall', *[''] * 7, *[rounded(report['overall'][metric]) for metric in metrics]])
+    print(tabulate(table, headers=headers, tablefmt=table_style, missingval='-'))
+
+
+@click.command()
+@click.option('--weather', multiple=True, default=(0.5,), type=float, show_default=True, help='Weather conditions to test (option can be repeated).')
+@click.option('--air-quality', multiple=True, default=(0.5,), type=float, show_default=True, help='Air quality values to test (option can be repeated).')
+@click.option('-w', '--week', multiple=True, default=(1,), type=int, show_default=True, help='Start weeks to test (option can be repeated).')
+@click.option('-d', '--day', multiple=True, default=(1,), type=int, show_default=True, help='Start days of week to test (option can be repeated).')
+@click.option('-t', '--time', multiple=True, default=('00:00:00',), show_default=True, help='Start times to test, in format hh:mm:ss (option can be repeated).')
+@click.option('--seed', multiple=True, default=(0,), type=int, show_default=True, help='Random seeds to test (option can be repeated).')
+@click.option('-p', '--processes', default=os.cpu_count(), type=click.IntRange(min=1), show_default=True, help='Number of simulations running at the same time.')
+@click.option('--base-port', default=8813, show_default=True, help='TraCI port of the first worker; next workers use consecutive ports.')
+@click.option('-o', '--output-dir', default='experiments', show_default=True, help='Directory for logs of all runs and the report.')
+@click.option('--copy-history/--empty-history', default=False, help='Start every run with a copy of the shared user history, or with an empty one.')
+def main(weather, air_quality, week, day, time, seed, processes, base_port, output_dir, copy_history):
+    configs = parameter_grid(weather, air_quality, week, day, time, seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    json_logs = run_experiments(configs, min(processes, len(configs)), base_port, output_dir, copy_history)
+    report = build_report(configs, json_logs)
+
+    with open(os.path.join(output_dir, 'report.json'), 'w') as out:
+        json.dump(report, out, indent=4)
+    print_report(report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
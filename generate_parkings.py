@@ -1,11 +1,14 @@
 import sys, os
 from lxml import etree as ET
-import xml.dom.minidom
 import random
-import psycopg2
+from math import cos, radians
 import click
 
 
+# Database driver and NumPy are imported only by the commands which need them.
+from xml_writer import XmlWriter
+from query_tracer import trace_options
+from trip_stream import AliasTable, iter_children, read_root, sorted_by_depart
 from constants import *
 
 
@@ -19,6 +22,7 @@ encoding = 'UTF-8'
 vehicle_length = 5.0    # in meters
 space_width = 3.2   # in meters
 space_length = 5.5  # in meters
+meters_per_deg_lat = 111132.
 
 min_stop_time = 500 # in seconds
 max_stop_time = 2000 # in seconds
@@ -27,141 +31,226 @@ time_base = 3600 # in seconds
 
 n_guided_vehicles = 500
 
-standalone_parking_index = 0
 
+def output_core(output=output_file):
+    # nsmap={'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
+    # attrib={'{http://www.w3.org/2001/XMLSchema-instance}noNamespaceSchemaLocation': 'http://sumo.dlr.de/xsd/additional_file.xsd'}
+    return XmlWriter(output, 'additional', encoding=encoding)
 
-def output_core():
-    root = ET.Element('additional')
-    # root.set('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance')
-    # root.set('xsi:noNamespaceSchemaLocation', 'http://sumo.dlr.de/xsd/additional_file.xsd')
-    return root
-    
 
-def save_output(output_tree, output=output_file):
-    dom = xml.dom.minidom.parseString(ET.tostring(output_tree))
-    xml_string = dom.toprettyxml()
-    part1, part2 = xml_string.split('?>')
+def save_trips(trips, root, output):
+    """ Writes stream of route file elements under root given as (tag, attributes, namespaces). """
+    tag, attrib, nsmap = root
+    with XmlWriter(output, tag, attrib, nsmap, encoding) as out:
+        for element in trips:
+            out.write(element)
 
-    with open(output, 'w', encoding=encoding) as out:
-        out.write(part1 + 'encoding=\"{}\"?>\n'.format(encoding) + part2)
 
+def way_id_of_edge(edge_id):
+    """ OSM way from which netconvert built an edge, e.g. "-123#4" -> "123". """
+    return edge_id.lstrip('-').split('#')[0]
 
-def add_roadside_parking(way, side, net_tree, output_tree):
-    id = way.attrib['id']
-    side_modifier = '-' if side == 'left' else ''
-    parking_kind = way.xpath(f'./tag[@k="parking:lane:{side}" or @k="parking:lane:both"]')[0].attrib['v']
 
-    lanes = net_tree.xpath(f'//edge/lane[starts-with(@id, "{side_modifier}{id}")]')
-    for lane in lanes:
-        parking = ET.SubElement(output_tree, 'parkingArea')
-        parking.set('id', f'parking_roadside_{lane.attrib["id"]}')
-        parking.set('lane', lane.attrib["id"])
+def read_lane_index(path=net_file):
+    """ Lanes of the net grouped by OSM way id: (lane id, length, is on reversed edge), in document order. """
+    lanes_of_way = {}
+
+    for _, elem in ET.iterparse(path, events=('end',)):
+        parent = elem.getparent()
+        if parent is None or parent.getparent() is not None:
+            continue    # root, or lanes and other descendants of top-level elements
+
+        edge_id = elem.get('id', '')
+        if elem.tag == 'edge' and elem.get('function') != 'internal' and not edge_id.startswith(':'):
+            lanes = lanes_of_way.setdefault(way_id_of_edge(edge_id), [])
+            for lane in elem.iterfind('lane'):
+                lanes.append((lane.attrib['id'], lane.attrib['length'], edge_id.startswith('-')))
+
+        # Junctions, connections etc. are dropped as well, not only the edges.
+        parent.remove(elem)
+
+    return lanes_of_way
+
+
+def roadside_parking_kind(tags, side):
+    """ Kind of parking on given side of a road (first matching tag), or None if there is no parking there. """
+    keys = (f'parking:lane:{side}', 'parking:lane:both')
+    values = [v for k, v in tags if k in keys]
+    if any(v not in ('no_stopping', 'no') for v in values):
+        return values[0]
+    return None
+
+
+def classify_ways(path=input_file):
+    """ Ways relevant to parking, found in two streaming passes over the OSM file.
+
+    Returns (ways with parking on the left: [(way id, parking kind)], same on
+    the right, standalone parkings: [(way id, [(lon, lat) of nodes])], parking
+    aisles: [way id]). The first pass classifies ways and collects node refs
+    of standalone parkings; the second resolves only those refs and stops at
+    the first way, as nodes precede ways in OSM files. Memory is thus bounded
+    by the returned ways and the nodes of parking lots, whatever the number of
+    nodes on the map.
+    """
+    left, right, standalone, aisles = [], [], [], []
+
+    for elem in _iter_osm_elements(path, ('node', 'way', 'relation')):
+        if elem.tag != 'way':
+            continue
+
+        way_id = elem.attrib['id']
+        tags = [(tag.attrib['k'], tag.attrib['v']) for tag in elem.iterfind('tag')]
+
+        left_kind = roadside_parking_kind(tags, 'left')
+        if left_kind is not None:
+            left.append((way_id, left_kind))
+        right_kind = roadside_parking_kind(tags, 'right')
+        if right_kind is not None:
+            right.append((way_id, right_kind))
+        if ('amenity', 'parking') in tags:
+            standalone.append((way_id, [nd.attrib['ref'] for nd in elem.iterfind('nd')]))
+        if ('service', 'parking_aisle') in tags:
+            aisles.append(way_id)
+
+    node_coords = dict.fromkeys(ref for _, refs in standalone for ref in refs)
+    for elem in _iter_osm_elements(path, ('node', 'way')):
+        if elem.tag == 'way':
+            break
+        if elem.attrib['id'] in node_coords:
+            node_coords[elem.attrib['id']] = (float(elem.attrib['lon']), float(elem.attrib['lat']))
+
+    standalone = [(way_id, [node_coords[ref] for ref in refs if node_coords[ref] is not None]) for way_id, refs in standalone]
+    return left, right, standalone, aisles
+
+
+def _iter_osm_elements(path, tags):
+    """ OSM elements with given tags; each one is cleared, together with everything before it, once the consumer is done with it. """
+    for _, elem in ET.iterparse(path, events=('end',), tag=tags):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def add_roadside_parking(way_id, side, parking_kind, lanes_of_way, out):
+    on_reversed_edge = side == 'left'
+
+    for lane_id, length, is_reversed in lanes_of_way.get(way_id, []):
+        if is_reversed != on_reversed_edge:
+            continue
+        parking = ET.Element('parkingArea')
+        parking.set('id', f'parking_roadside_{lane_id}')
+        parking.set('lane', lane_id)
         parking.set('startPos', '0.0')
-        parking.set('endPos', lane.attrib['length'])
-        parking.set('roadsideCapacity', str(int(float(lane.attrib['length']) // vehicle_length)))
+        parking.set('endPos', length)
+        parking.set('roadsideCapacity', str(int(float(length) // vehicle_length)))
 
         if parking_kind == 'perpendicular':
             parking.set('angle', '90.0')
         elif parking_kind == 'diagonal':
             parking.set('angle', '60.0')
+        out.write(parking)
 
 
-def add_standalone_parking(way, net_tree, output_tree):
-    way_id = way.attrib['id']
-    lanes = net_tree.xpath(f'//edge/lane[starts-with(@id, "{way_id}") or starts-with(@id, "-{way_id}")]')
-    if lanes:
-        lane = lanes[0]
-        parking = ET.SubElement(output_tree, 'parkingArea')
-        parking.set('id', f'parking_standalone_{standalone_parking_index}')
-        parking.set('lane', lane.attrib["id"])
-        parking.set('startPos', '0.0')
-        parking.set('endPos', lane.attrib['length'])
-        parking.set('angle', '90.0')
+def parking_lot_capacity(outline):
+    """ Number of spaces fitting into a parking lot outlined by (lon, lat) nodes, at least one. """
+    if len(outline) < 3:
+        return 1
 
-        spaces = way.xpath('./nd')
-        for space_elem in spaces:
-            space = ET.SubElement(parking, 'space')
-            space.set('x', space_elem.attrib['lon'])
-            space.set('y', space_elem.attrib['lat'])
-            space.set('width', space_width)
-            space.set('length', space_length)
-    # else:
-        # print(f'WARNING: no lanes found for way {way_id}')
+    lons, lats = zip(*((float(lon), float(lat)) for lon, lat in outline))
+    meters_per_deg_lon = meters_per_deg_lat * cos(radians(sum(lats) / len(lats)))
+    xs = [lon * meters_per_deg_lon for lon in lons]
+    ys = [lat * meters_per_deg_lat for lat in lats]
+    area = abs(sum(xs[i - 1] * ys[i] - xs[i] * ys[i - 1] for i in range(len(xs)))) / 2
+    return max(1, int(area // (space_width * space_length)))
 
 
-def add_parking_along_aisle(way, net_tree, output_tree):
-    id = way.attrib['id']
+def add_standalone_parking(index, way_id, outline, lanes_of_way, out):
+    """ Adds parking area at the first lane of the way; returns False if the way has no lanes.
 
-    lanes = net_tree.xpath(f'//edge/lane[starts-with(@id, "{id}") or starts-with(@id, "-{id}")]')
-    for lane in lanes:
-        parking = ET.SubElement(output_tree, 'parkingArea')
-        parking.set('id', f'parking_aisle_{lane.attrib["id"]}')
-        parking.set('lane', lane.attrib["id"])
+    Nodes of the way outline the lot in lon/lat, while SUMO expects spaces in
+    net coordinates, so the lot is modelled by its roadside capacity only.
+    """
+    lanes = lanes_of_way.get(way_id)
+    if not lanes:
+        # print(f'WARNING: no lanes found for way {way_id}')
+        return False
+
+    lane_id, length, _ = lanes[0]
+    parking = ET.Element('parkingArea')
+    parking.set('id', f'parking_standalone_{index}')
+    parking.set('lane', lane_id)
+    parking.set('startPos', '0.0')
+    parking.set('endPos', length)
+    parking.set('roadsideCapacity', str(parking_lot_capacity(outline)))
+    parking.set('angle', '90.0')
+    out.write(parking)
+    return True
+
+
+def add_parking_along_aisle(way_id, lanes_of_way, out):
+    for lane_id, length, _ in lanes_of_way.get(way_id, []):
+        parking = ET.Element('parkingArea')
+        parking.set('id', f'parking_aisle_{lane_id}')
+        parking.set('lane', lane_id)
         parking.set('startPos', '0.0')
-        parking.set('endPos', lane.attrib['length'])
-        parking.set('roadsideCapacity', str(int(float(lane.attrib['length']) // space_width)))
+        parking.set('endPos', length)
+        parking.set('roadsideCapacity', str(int(float(length) // space_width)))
         parking.set('angle', '90.0')
+        out.write(parking)
 
 
-def add_parkings_along_roads(input_tree, net_tree, output_tree):
-    ways_with_parking_on_left = input_tree.xpath('//way[./tag[(@k="parking:lane:left" or @k="parking:lane:both") and @v!="no_stopping" and @v!="no"]]')
-    ways_with_parking_on_right = input_tree.xpath('//way[./tag[(@k="parking:lane:right" or @k="parking:lane:both") and @v!="no_stopping" and @v!="no"]]')
-
-    for way in ways_with_parking_on_left:
-        add_roadside_parking(way, 'left', net_tree, output_tree)
-
-    for way in ways_with_parking_on_right:
-        add_roadside_parking(way, 'right', net_tree, output_tree)
+def add_parkings_along_roads(ways_with_parking_on_left, ways_with_parking_on_right, lanes_of_way, out):
+    for way_id, parking_kind in ways_with_parking_on_left:
+        add_roadside_parking(way_id, 'left', parking_kind, lanes_of_way, out)
 
+    for way_id, parking_kind in ways_with_parking_on_right:
+        add_roadside_parking(way_id, 'right', parking_kind, lanes_of_way, out)
 
-def add_standalone_parkings(input_tree, net_tree, output_tree):
-    ways_with_standalone_parking = input_tree.xpath('//way[./tag[@k="amenity" and @v="parking"]]')
 
-    for way in ways_with_standalone_parking:
-        add_standalone_parking(way, net_tree, output_tree)
+def add_standalone_parkings(ways_with_standalone_parking, lanes_of_way, out):
+    n_added = 0
+    for way_id, outline in ways_with_standalone_parking:
+        if add_standalone_parking(n_added, way_id, outline, lanes_of_way, out):
+            n_added += 1
 
 
-def add_parkings_along_aisles(input_tree, net_tree, output_tree):
-    parking_aisles = input_tree.xpath('//way[./tag[@k="service" and @v="parking_aisle"]]')
-    for aisle in parking_aisles:
-        add_parking_along_aisle(aisle, net_tree, output_tree)
+def add_parkings_along_aisles(parking_aisles, lanes_of_way, out):
+    for way_id in parking_aisles:
+        add_parking_along_aisle(way_id, lanes_of_way, out)
 
 
-def add_stops_to_random_trips(trips_tree, output_tree):
-    parkings = output_tree.xpath('/additional/parkingArea')
-    trips = trips_tree.xpath('/routes/trip')
+def add_stops_to_random_trips(trips, parkings):
+    """ Adds stop at a parking area, drawn with probability proportional to its capacity, to every trip of a stream. """
+    parking_table = AliasTable(parkings.capacity.tolist())
 
-    parking_assignments = random.choices(parkings, weights=[int(parking.attrib['roadsideCapacity']) for parking in parkings], k=len(trips))
-    for i, trip, parking in zip(range(len(trips)), trips, parking_assignments):
-        stop = ET.SubElement(trip, 'stop')
-        stop.set('parkingArea', parking.attrib['id'])
-        stop.set('duration', str(random.randint(min_stop_time, max_stop_time)))
-        # trip.set('via', parking.attrib['lane'].split('_')[0])
-        trip.set('depart', str(float(trip.attrib['depart']) + time_base * (i % stopping_rate)))
+    i = 0
+    for trip in trips:
+        if trip.tag == 'trip':
+            stop = ET.SubElement(trip, 'stop')
+            stop.set('parkingArea', parkings.ids[parking_table.sample(random)])
+            stop.set('duration', str(random.randint(min_stop_time, max_stop_time)))
+            # trip.set('via', parking.attrib['lane'].split('_')[0])
+            trip.set('depart', str(float(trip.attrib['depart']) + time_base * (i % stopping_rate)))
+            i += 1
+        yield trip
 
-    all_trips = trips_tree.find('.')
-    all_trips[:] = sorted(all_trips, key=lambda trip: float(trip.attrib['depart']) if trip.tag == 'trip' else 0.0)
 
+def add_parkings_to_db(parkings):
+    import psycopg2
+    from database import shared_database
 
-def add_parkings_to_db(output_tree):
     try:
-        conn = psycopg2.connect(conn_string)
-        cur = conn.cursor()
-
-        sql = 'INSERT INTO parkings(id, road_id) VALUES(%s, %s)'
+        db = shared_database()
+        db.register('parkings_insert', 'insert into parkings(id, road_id) values($1, $2)', ('varchar', 'bigint'))
 
         road_id = lambda lane_id: int(lane_id.split('#')[0].split('_')[0].split('-')[-1])
-        values = [(parking.attrib['id'], road_id(parking.attrib['lane'])) for parking in output_tree.xpath('/additional/parkingArea')]
+        values = [(parking, road_id(lane)) for parking, lane in zip(parkings.ids, parkings.lanes)]
 
-        cur.executemany(sql, values)
-        
-        conn.commit()
-        cur.close()
+        db.execute_many('parkings_insert', values)
+        db.execute_sql('select snap_static_points()')
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
 
 
 def pick_guided_vehicles(trips_tree):
@@ -176,33 +265,33 @@ def pick_guided_vehicles(trips_tree):
 
 @click.command()
 def extract():
-    output_tree = output_core()
-    input_tree = ET.parse(input_file)
-    net_tree = ET.parse(net_file)
-
-    add_parkings_along_roads(input_tree, net_tree, output_tree)
-    add_standalone_parkings(input_tree, net_tree, output_tree)
-    add_parkings_along_aisles(input_tree, net_tree, output_tree)
+    lanes_of_way = read_lane_index(net_file)
+    left, right, standalone, aisles = classify_ways(input_file)
 
-    save_output(output_tree)
+    with output_core() as out:
+        add_parkings_along_roads(left, right, lanes_of_way, out)
+        add_standalone_parkings(standalone, lanes_of_way, out)
+        add_parkings_along_aisles(aisles, lanes_of_way, out)
 
 
 @click.command()
 def load():
-    trips_tree = ET.parse(random_trips_file)
-    output_tree = ET.parse(output_file)
+    from parking_registry import ParkingRegistry
+
+    parkings = ParkingRegistry.cached(output_file)
 
-    add_stops_to_random_trips(trips_tree, output_tree)
+    trips = add_stops_to_random_trips(iter_children(random_trips_file), parkings)
+    save_trips(sorted_by_depart(trips), read_root(random_trips_file), random_trips_file)
 
-    add_parkings_to_db(output_tree)
+    add_parkings_to_db(parkings)
 
     # add_guided_v_type(trips_tree)
     # pick_guided_vehicles(trips_tree)
-    save_output(trips_tree, output=random_trips_file)
 
 
 @click.group()
-def cli():
+@trace_options
+def cli(tracer):
     pass
 
 
@@ -1,11 +1,14 @@
 import sys, os
+import itertools
+from functools import lru_cache
 from lxml import etree as ET
-import xml.dom.minidom
 import random
-import psycopg2
 import click
 
-from generate_parkings import save_output
+from generate_parkings import save_trips
+from trip_stream import iter_children, read_root, sorted_by_depart
+from xml_writer import XmlWriter
+from query_tracer import trace_options
 from constants import *
 
 
@@ -39,41 +42,22 @@ min_stop_time = 500
 max_stop_time = 2000
 
 
+@lru_cache(maxsize=None)
 def get_parkings():
-    parking_tree = ET.parse(parkings_file)
-    return [p.attrib['id'] for p in parking_tree.xpath('/additional/parkingArea')]
-
-def get_roads():
-    osm = ET.parse(net_file)
-    return [e.attrib['id'].split(':')[-1] for e in osm.xpath('/net/edge') if not str.startswith(e.attrib['id'], ':cluster') and 'function' not in e.attrib]
+    from parking_registry import ParkingRegistry
+    return ParkingRegistry.cached(parkings_file).ids
 
+@lru_cache(maxsize=None)
 def get_buildings():
     osm = ET.parse(buildings_file)
     return [e.text for e in osm.xpath('building/name')]
 
 days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-buildings = get_buildings()
-parkings = get_parkings()
-roads = get_roads()
 
 sources = ['277117089', '277117080', '-21094558#7', '558612810#0', '-277424358', '370453642']
 sinks = ['431516755#1', '114324803#3', '21094558#4', '277424367#1', '277424358', '-370453642']
 
 
-def xml_root(root_element_name):
-    root = ET.Element(root_element_name)
-    return root
-
-
-def save_output(output_tree, output):
-    dom = xml.dom.minidom.parseString(ET.tostring(output_tree))
-    xml_string = dom.toprettyxml()
-    part1, part2 = xml_string.split('?>')
-
-    with open(output, 'w', encoding=encoding) as out:
-        out.write(part1 + 'encoding=\"{}\"?>\n'.format(encoding) + part2)
-
-
 def fill_random_calendar(calendar):
     n_entries = random.randint(0, max_n_calendar_entries)
     i = 0
@@ -93,29 +77,22 @@ def fill_random_calendar(calendar):
         event = ET.SubElement(calendar, 'event')
         event.set('day', days[day_ix])
         event.set('time', str(time))
-        event.set('place', random.choice(buildings))
+        event.set('place', random.choice(get_buildings()))
 
         time += random.randint(min_time_between_events, 3600 * (max_event_hour - min_event_hour))
 
 
 def find_parking_area(target):
-    try:
-        conn = psycopg2.connect(conn_string)
-        cur = conn.cursor()
-
-        sql = 'select id from get_parkings_around_building(%s, %s)'
+    import psycopg2
+    from database import shared_database
 
-        cur.execute(sql, (target, 5))
-        nearby_parkings = [p[0] for p in cur.fetchall()]
-        
-        conn.commit()
-        cur.close()
+    try:
+        db = shared_database()
+        db.register('users_nearest_parkings', 'select id from get_parkings_around_building($1, $2)', ('varchar', 'int'))
+        nearby_parkings = [p[0] for p in db.fetch_all('users_nearest_parkings', (target, 5))]
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-        nearby_parkings = random.choices(parkings, k=5)
-    finally:
-        if conn is not None:
-            conn.close()
+        nearby_parkings = random.choices(get_parkings(), k=5)
 
     return random.choice(nearby_parkings)
 
@@ -163,7 +140,7 @@ def fill_random_trips(user_id, trips, calendar):
             time = random_trip_time(trips)
             trip.set('time', str(time))
 
-            trip.set('target', random.choice(buildings))
+            trip.set('target', random.choice(get_buildings()))
             trip_id += 1
 
     trips[:] = sorted(trips, key=lambda trip: float(trip.attrib['time']))
@@ -178,56 +155,56 @@ def fill_random_user(id, user):
     fill_random_trips(id, trips, calendar)
 
 
-def generate_users(users_tree):
+def generate_users(out):
     for i in range(n_users):
-        user = ET.SubElement(users_tree, 'user')
+        user = ET.Element('user')
         fill_random_user(i, user)
+        out.write(user)
 
 
-def add_guided_v_type(trips_tree):
-    v_type = ET.SubElement(trips_tree, 'vType')
+def guided_v_type():
+    v_type = ET.Element('vType')
     v_type.set('id', 'veh_guided')
     v_type.set('vClass', 'passenger')
     v_type.set('color', '0,0,255')
+    return v_type
 
 
-def prepare_users_trips(users_tree, users_trips_tree):
-    trips = users_tree.xpath('/users/user/trips/trip')
-    for trip in trips:
-        trip_el = ET.SubElement(users_trips_tree, 'trip')
-        trip_el.set('id', trip.attrib['id'])
-        trip_el.set('type', 'veh_guided')
-        trip_el.set('depart', trip.attrib['time'])
-        trip_el.set('departLane', 'best')
-        trip_el.set('from', random.choice(sources))
-        trip_el.set('to', random.choice(sinks))
+def prepare_users_trips(users_file=output_users_file):
+    """ Trip of a guided vehicle, with stop near its target, for every trip in users file; read one user at a time. """
+    for _, user in ET.iterparse(users_file, events=('end',), tag='user'):
+        for trip in user.iterfind('trips/trip'):
+            trip_el = ET.Element('trip')
+            trip_el.set('id', trip.attrib['id'])
+            trip_el.set('type', 'veh_guided')
+            trip_el.set('depart', trip.attrib['time'])
+            trip_el.set('departLane', 'best')
+            trip_el.set('from', random.choice(sources))
+            trip_el.set('to', random.choice(sinks))
 
-        stop = ET.SubElement(trip_el, 'stop')
-        stop.set('parkingArea', find_parking_area(trip.attrib['target']))
-        stop.set('duration', str(random.randint(min_stop_time, max_stop_time)))
+            stop = ET.SubElement(trip_el, 'stop')
+            stop.set('parkingArea', find_parking_area(trip.attrib['target']))
+            stop.set('duration', str(random.randint(min_stop_time, max_stop_time)))
+            yield trip_el
 
-    users_trips_tree[:] = sorted(users_trips_tree, key=lambda trip: float(trip.attrib['depart']) if trip.tag == 'trip' else 0.0)
+        user.clear()
 
 
 @click.command()
 def generate():
-    users_tree = xml_root('users')
-    generate_users(users_tree)
-    save_output(users_tree, output_users_file)
+    with XmlWriter(output_users_file, 'users', encoding=encoding) as out:
+        generate_users(out)
 
 
 @click.command()
 def load():
-    users_tree = ET.parse(output_users_file)
-    users_trips_tree = ET.parse(trips_file).find('.')
-
-    add_guided_v_type(users_trips_tree)
-    prepare_users_trips(users_tree, users_trips_tree)
-    save_output(users_trips_tree, trips_file)
+    trips = itertools.chain(iter_children(trips_file), [guided_v_type()], prepare_users_trips(output_users_file))
+    save_trips(sorted_by_depart(trips), read_root(trips_file), trips_file)
 
 
 @click.group()
-def cli():
+@trace_options
+def cli(tracer):
     pass
 
 
@@ -0,0 +1,117 @@
+from bisect import bisect_left, bisect_right, insort
+from math import inf
+import threading
+
+
+from constants import *
+
+
+class UserHistory:
+    """ Targets chosen by a single user.
+
+    Records are kept in insertion order; `_by_absolute_time` orders them by
+    absolute time and `_by_time_of_week` is a sorted (time_of_week, record)
+    index queried as a circular range over the week.
+    """
+
+    __slots__ = ('buildings', 'times_of_week', 'absolute_times', '_by_absolute_time', '_by_time_of_week')
+
+    def __init__(self):
+        self.buildings = []
+        self.times_of_week = []
+        self.absolute_times = []
+        self._by_absolute_time = []
+        self._by_time_of_week = []
+
+
+    def add(self, building, time_of_week, absolute_time):
+        record = len(self.buildings)
+        self.buildings.append(building)
+        self.times_of_week.append(time_of_week)
+        self.absolute_times.append(absolute_time)
+
+        if not self._by_absolute_time or absolute_time >= self.absolute_times[self._by_absolute_time[-1][1]]:
+            self._by_absolute_time.append((absolute_time, record))
+        else:
+            insort(self._by_absolute_time, (absolute_time, record))
+        insort(self._by_time_of_week, (time_of_week % WEEK_LEN_SECONDS, record))
+
+
+    def by_absolute_time(self):
+        return [(self.buildings[r], self.absolute_times[r]) for _, r in self._by_absolute_time]
+
+
+    def within_time_of_week(self, start, end, building=None):
+        """ Records with start < time_of_week < end, where the window may wrap around the end of the week. """
+        length = end - start
+        if length >= WEEK_LEN_SECONDS:
+            records = [r for _, r in self._by_time_of_week]
+        else:
+            start %= WEEK_LEN_SECONDS
+            end = start + length
+            records = self._records_between(start, min(end, WEEK_LEN_SECONDS))
+            if end > WEEK_LEN_SECONDS:
+                records += self._records_between(-inf, end - WEEK_LEN_SECONDS)
+
+        return [
+            (self.buildings[r], self.times_of_week[r], self.absolute_times[r])
+            for r in records if building is None or self.buildings[r] == building
+        ]
+
+
+    def _records_between(self, start, end):
+        lo = bisect_right(self._by_time_of_week, (start, inf))
+        hi = bisect_left(self._by_time_of_week, (end, -inf))
+        return [r for _, r in self._by_time_of_week[lo:hi]]
+
+
+class HistoryStore:
+    """ In-memory copy of the user_history table, keyed by user id.
+
+    Loaded once at startup; the database remains the durable copy, so every
+    target saved through the advisor is added both here and there.
+    """
+
+    def __init__(self):
+        self._histories = {}
+        self._lock = threading.Lock()
+
+
+    @classmethod
+    def load(cls, db):
+        db.register('history_load', 'select user_id, building, time_of_week, absolute_time from user_history order by user_id, absolute_time')
+
+        store = cls()
+        for user_id, building, time_of_week, absolute_time in db.fetch_all('history_load'):
+            store.add(user_id, building, int(time_of_week), int(absolute_time))
+        return store
+
+
+    def add(self, user_id, building, time_of_week, absolute_time):
+        with self._lock:
+            self._histories.setdefault(str(user_id), UserHistory()).add(building, time_of_week, absolute_time)
+
+
+    def clear(self):
+        with self._lock:
+            self._histories = {}
+
+
+    def buildings(self, user_id):
+        with self._lock:
+            history = self._histories.get(str(user_id))
+            return set(history.buildings) if history else set()
+
+
+    def records(self, user_id):
+        """ (building, absolute_time) of every record of the user, oldest first. """
+        with self._lock:
+            history = self._histories.get(str(user_id))
+            return history.by_absolute_time() if history else []
+
+
+    def within_time_of_week(self, user_id, start, end, building=None):
+        """ (building, time_of_week, absolute_time) of user's records falling into circular window (start, end). """
+        with self._lock:
+            history = self._histories.get(str(user_id))
+            return history.within_time_of_week(start, end, building) if history else []
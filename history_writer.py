@@ -0,0 +1,47 @@
+import psycopg2
+
+
+from write_behind import WriteBehindQueue
+from constants import *
+
+
+class HistoryWriter:
+    """ Write-behind persistence of user_history records.
+
+    Records are queued by the caller and inserted by a background thread with
+    multi-row inserts, once `batch_size` records are pending or the oldest
+    one has waited `flush_interval` seconds. Readers use HistoryStore, which
+    is updated synchronously, so queued records are visible immediately.
+    """
+
+    def __init__(self, db, batch_size=HISTORY_BATCH_SIZE, flush_interval=HISTORY_FLUSH_INTERVAL_SEC):
+        self._db = db
+        self._queue = WriteBehindQueue(self._write, 'history-writer', batch_size, flush_interval)
+
+
+    def put(self, record):
+        self._queue.put(record)
+
+
+    def flush(self):
+        """ Writes all pending records synchronously. """
+        self._queue.flush()
+
+
+    def discard(self):
+        """ Drops pending records and waits for the write in progress, if any. """
+        self._queue.discard()
+
+
+    def close(self):
+        """ Stops the background thread after it has written everything still pending. """
+        self._queue.close()
+
+
+    def _write(self, batch):
+        try:
+            with self._db.connection() as conn:
+                with conn.cursor() as cur:
+                    self._db.execute_values(cur, 'insert into user_history values %s on conflict do nothing', batch, 'history_insert')
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
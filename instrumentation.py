@@ -0,0 +1,166 @@
+from functools import wraps
+from math import log2
+import json
+import threading
+import time
+
+
+# Histogram buckets grow by 2^(1/4) (~19%) from 1 us; the last one collects everything above ~18 minutes.
+BUCKETS_PER_OCTAVE = 4
+N_BUCKETS = 30 * BUCKETS_PER_OCTAVE
+MIN_VALUE_SEC = 1e-6
+
+PERCENTILES = [50, 95, 99]
+
+
+class Histogram:
+    """ Log-bucketed distribution of durations in seconds; percentiles are upper bounds of their buckets. """
+
+    __slots__ = ('counts', 'n', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * N_BUCKETS
+        self.n = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+
+    def record(self, value):
+        bucket = int(log2(value / MIN_VALUE_SEC) * BUCKETS_PER_OCTAVE) if value > MIN_VALUE_SEC else 0
+        self.counts[min(bucket, N_BUCKETS - 1)] += 1
+        self.n += 1
+        self.total += value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+
+
+    def percentile(self, p):
+        rank = p / 100 * self.n
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(MIN_VALUE_SEC * 2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE), self.max)
+        return self.max
+
+
+    def summary(self):
+        return {
+            'count': self.n,
+            'total': self.total,
+            'mean': self.total / self.n if self.n else None,
+            'min': self.min,
+            'max': self.max,
+            **{f'p{p}': self.percentile(p) for p in PERCENTILES}
+        }
+
+
+class _StageTimer:
+    __slots__ = ('_instruments', '_name', '_start')
+
+    def __init__(self, instruments, name):
+        self._instruments = instruments
+        self._name = name
+
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self._instruments.observe(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Instrumentation:
+    """ Stage timers and counters of the recommendation path.
+
+    Disabled by default: `stage` then returns a shared no-op context manager
+    and `count` returns right away, so instrumented code pays a method call
+    and an attribute check. When enabled, durations are collected into
+    histograms and counts into plain counters, both safe to update from
+    several threads.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+
+    def enable(self):
+        self.enabled = True
+
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+
+    def stage(self, name):
+        """ Context manager timing the enclosed block as stage `name`. """
+        return _StageTimer(self, name) if self.enabled else _null_timer
+
+
+    def timed(self, name):
+        """ Decorator timing every call of a function as stage `name`. """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _StageTimer(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.record(value)
+
+
+    def summary(self):
+        with self._lock:
+            return {
+                'stages': {name: histogram.summary() for name, histogram in sorted(self._histograms.items())},
+                'counters': dict(sorted(self._counters.items()))
+            }
+
+
+    def dump(self, path):
+        with open(path, 'w') as out:
+            json.dump(self.summary(), out, indent=4)
+
+
+instruments = Instrumentation()
@@ -1,9 +1,13 @@
 import imp
 import os
+import sys
+import click
 from lxml import etree as ET
 import psycopg2
 
 
+from database import shared_database
+from query_tracer import trace_options
 from constants import *
 
 buildings_file = os.path.join(sumo_rel_path, config_subdir, buildings_filename)
@@ -16,28 +20,25 @@ def get_buildings():
 
 def load_buildings_to_db(buildings):
     try:
-        conn = psycopg2.connect(conn_string)
-        cur = conn.cursor()
-
-        sql = 'DELETE FROM buildings; '
-        cur.execute(sql)
-
-        sql = 'INSERT INTO buildings(name, lon, lat) VALUES(%s, %s, %s)'
-        cur.executemany(sql, buildings)
-        
-        conn.commit()
-        cur.close()
+        db = shared_database()
+        db.register('buildings_insert', 'insert into buildings(name, lon, lat) values($1, $2, $3)', ('varchar', 'float', 'float'))
+
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                db.execute_sql_on(cur, 'DELETE FROM buildings')
+                for building in buildings:
+                    db.execute_prepared(cur, 'buildings_insert', building)
+                db.execute_sql_on(cur, 'select snap_static_points()')
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
 
 
-def main():
+@click.command()
+@trace_options
+def main(tracer):
     buildings = get_buildings()
     load_buildings_to_db(buildings)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
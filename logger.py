@@ -1,20 +1,161 @@
+import json
+import sys
+import time
 import click
 
 
+from write_behind import WriteBehindQueue
+from constants import *
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+
+class TextSink:
+    """ Human readable log: console (path=None) or plain text file. """
+
+    def __init__(self, level, path=None):
+        self.level = level
+        self._file = open(path, 'a', buffering=1 << 16) if path else None
+
+
+    def write(self, text):
+        if self._file is None:
+            click.echo(text)
+        else:
+            self._file.write(text + '\n')
+
+
+    def flush(self):
+        if self._file is None:
+            sys.stdout.flush()
+        else:
+            self._file.flush()
+
+
+    def clear(self):
+        if self._file is not None:
+            self._file.flush()
+            self._file.truncate(0)
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class JsonLinesSink:
+    """ Machine readable log: one JSON object per structured event. """
+
+    def __init__(self, level, path):
+        self.level = level
+        self._file = open(path, 'a', buffering=1 << 16)
+
+
+    def write(self, record):
+        self._file.write(json.dumps(record, default=str) + '\n')
+
+
+    def flush(self):
+        self._file.flush()
+
+
+    def clear(self):
+        self._file.flush()
+        self._file.truncate(0)
+
+
+    def close(self):
+        self._file.close()
+
+
 class Logger:
-    def __init__(self, is_quiet, output_file):
-        self._is_quiet = is_quiet
-        self._output_file = output_file
+    """ Log with levels, written by a background thread.
+
+    `log` takes either a string or a zero-argument callable returning one;
+    a callable is invoked (in the writer thread) only if some text sink
+    accepts the level, so expensive messages such as tables cost nothing
+    when nobody reads them. `event` records structured data, which is
+    written only to the JSON-lines sink. Records go through a
+    write_behind.WriteBehindQueue: sinks are written and flushed once
+    `batch_size` records are pending or the oldest one has waited
+    `flush_interval` seconds.
+    """
+
+    def __init__(self, is_quiet, output_file, level=INFO, json_file='', batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL_SEC):
+        self._text_sinks = []
+        if not is_quiet:
+            self._text_sinks.append(TextSink(level))
+        if output_file:
+            self._text_sinks.append(TextSink(level, output_file))
+        self._json_sink = JsonLinesSink(level, json_file) if json_file else None
+
+        self._text_level = min((sink.level for sink in self._text_sinks), default=None)
+        self._queue = WriteBehindQueue(self._write, 'log-writer', batch_size, flush_interval)
+
+
+    def wants_text(self, level=INFO):
+        return self._text_level is not None and level >= self._text_level
+
+
+    def wants_events(self, level=INFO):
+        return self._json_sink is not None and level >= self._json_sink.level
+
+
+    def log(self, message, level=INFO):
+        if self.wants_text(level):
+            self._put((level, message, None, None))
 
 
-    def log(self, message):
-        if not self._is_quiet:
-            click.echo(message)
-        if self._output_file:
-            with open(self._output_file, 'a') as out:
-                out.write(message + '\n')
+    def event(self, name, level=INFO, **fields):
+        if self.wants_events(level):
+            self._put((level, None, name, fields))
 
 
     def clear_log(self):
-        if self._output_file:
-            open(self._output_file, 'w').close()
+        self.flush()
+        for sink in self._sinks():
+            sink.clear()
+
+
+    def flush(self):
+        """ Writes all pending records synchronously. """
+        self._queue.flush()
+
+
+    def close(self):
+        """ Stops the background thread after it has written everything still pending. """
+        self._queue.close()
+        for sink in self._sinks():
+            sink.close()
+
+
+    def _put(self, record):
+        self._queue.put((time.time(), *record))
+
+
+    def _write(self, batch):
+        for timestamp, level, message, name, fields in batch:
+            if name is None:
+                try:
+                    text = message() if callable(message) else message
+                except Exception as error:
+                    text = f'Cannot render log message: {error!r}'
+                for sink in self._text_sinks:
+                    if level >= sink.level:
+                        sink.write(text)
+            else:
+                self._json_sink.write({'time': timestamp, 'level': LEVEL_NAMES.get(level, level), 'event': name, **fields})
+
+        for sink in self._sinks():
+            sink.flush()
+
+
+    def _sinks(self):
+        return self._text_sinks + ([self._json_sink] if self._json_sink is not None else [])
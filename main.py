@@ -1,29 +1,18 @@
 import os, sys, random
 from time import sleep
-import traci
-from traci.exceptions import FatalTraCIError, TraCIException
-from lxml import etree as ET
 import click
-from tabulate import tabulate
 
 
-from parking_advisor import ParkingAdvisor
-from time_controller import TimeController
-from logger import Logger
+# TraCI, NumPy, lxml and the database driver are imported by the functions
+# which use them, so that --help and argument errors don't wait for them.
+from logger import Logger, LEVELS, WARNING
+from instrumentation import instruments, PERCENTILES
 from environment import Environment
+from query_tracer import trace_options
 from constants import *
 
 
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("please declare environment variable 'SUMO_HOME'")
-
-
 sumocfg_path = os.path.join(sumo_rel_path, config_subdir, sumocfg_filename)
-users_file = os.path.join(sumo_rel_path, config_subdir, users_conf_filename)
-parkings_file = os.path.join(sumo_rel_path, gen_subdir, parkings_gen_filename)
 
 table_style = 'pretty'
 
@@ -43,76 +32,184 @@ def suggestion_pos(suggested_targets, true_target):
         return f'{pos}th suggestion'
 
 
-def evaluate_target_suggestions(guided_veh, true_target, suggested_targets, advisor, logger):
-    logger.log(f'\n{"=" * 15} User {(guided_veh.split("_")[0][3:])} activated application {"=" * 15}')
+def add_sumo_tools_to_path():
+    if 'SUMO_HOME' in os.environ:
+        tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
+        sys.path.append(tools)
+    else:
+        sys.exit("please declare environment variable 'SUMO_HOME'")
+
+
+def evaluate_target_suggestions(request, true_target, logger):
+    suggested_targets = request.suggested_targets
+    rank = suggested_targets.index(true_target) + 1 if true_target in suggested_targets else None
+
+    logger.event('suggestions', vehicle=request.vehicle, user=request.user_id, suggested=suggested_targets, true_target=true_target, rank=rank)
+    logger.log(f'\n{"=" * 15} User {request.user_id} activated application {"=" * 15}')
     logger.log(f'suggested: {suggested_targets}')
     logger.log(f'true: {true_target} ({suggestion_pos(suggested_targets, true_target)})\n')
 
     if suggested_targets:
-        conf_components_first = advisor.confidence_components(suggested_targets[0])
-        conf_components_true = advisor.confidence_components(true_target)
         logger.log('Confidence components:')
-
-        headers = ['Component', 'True target', 'First suggestion']
-        table = [[comp, conf_components_true[comp], conf_components_first[comp]] for comp in conf_components_first]
-        table.append(['Overall', sum(conf_components_true.values()), sum(conf_components_first.values())])
-        logger.log(tabulate(table, headers, tablefmt=table_style))
+        logger.log(lambda: confidence_table(request, true_target))
         logger.log('')
 
 
-def log_weights_summary(logger, parking_advisor):
-    logger.log('Context:')
-    logger.log(tabulate(parking_advisor.context.items(), headers=['Feature', 'Value'], tablefmt=table_style))
+def confidence_table(request, true_target):
+    from tabulate import tabulate
+
+    conf_components_first = request.confidence_components(request.suggested_targets[0])
+    conf_components_true = request.confidence_components(true_target)
+
+    headers = ['Component', 'True target', 'First suggestion']
+    table = [[comp, conf_components_true[comp], conf_components_first[comp]] for comp in conf_components_first]
+    table.append(['Overall', sum(conf_components_true.values()), sum(conf_components_first.values())])
+    return tabulate(table, headers, tablefmt=table_style)
 
-    weights = [[parking_advisor.weight_time, parking_advisor.weight_walking, parking_advisor.weight_prob]]
+
+def log_weights_summary(logger, request):
+    from tabulate import tabulate
+
+    weights = [[request.weight_time, request.weight_walking, request.weight_prob]]
     headers = ['Total time', 'Walking time', 'Prob of success']
 
+    logger.event('weights', vehicle=request.vehicle, context=request.context, weights=dict(zip(['time_total', 'time_walking', 'prob_of_success'], weights[0])))
+    logger.log('Context:')
+    logger.log(lambda: tabulate(request.context.items(), headers=['Feature', 'Value'], tablefmt=table_style))
+
     logger.log('\nWeights:')
-    logger.log(tabulate(weights, headers, tablefmt=table_style))
+    logger.log(lambda: tabulate(weights, headers, tablefmt=table_style))
 
     logger.log('')
 
 
-def log_costs_summary(logger, parking_advisor, parking_areas):
-    logger.log('\nCosts:')
-    
+def log_costs_summary(logger, request):
+    from tabulate import tabulate
+
     headers = ['Parking area', 'Time total', 'Time walking', 'Prob of success', 'Total Cost']
-    costs = [[parking_area, *parking_advisor.costs[parking_area]] for parking_area in parking_areas]
-    logger.log(tabulate(costs, headers=headers, tablefmt=table_style))
+    costs = [[parking_area, *request.costs[parking_area]] for parking_area in request.parking_areas]
+
+    logger.event('costs', vehicle=request.vehicle, costs=[dict(zip(['parking_area', 'time_total', 'time_walking', 'prob_of_success', 'cost'], row)) for row in costs])
+    logger.log('\nCosts:')
+    logger.log(lambda: tabulate(costs, headers=headers, tablefmt=table_style))
     logger.log('')
 
 
+def log_pool_summary(logger):
+    from tabulate import tabulate
+    from database import shared_database
+
+    stats = shared_database().wait_stats()
+    logger.event('database_pool', **stats)
+    logger.log('Database pool:')
+    logger.log(lambda: tabulate([[stats['checkouts'], stats['total_wait'], stats['mean_wait'], stats['max_wait']]], headers=['Checkouts', 'Total wait [s]', 'Mean wait [s]', 'Max wait [s]'], tablefmt=table_style))
+
+
+def count_traci_calls():
+    """ Counts every command sent to SUMO as driver.traci_calls; reading subscription results costs no call and is not counted. """
+    from traci.connection import Connection
+
+    send = Connection._sendExact
+    def counted_send(self, *args, **kwargs):
+        instruments.count('driver.traci_calls')
+        return send(self, *args, **kwargs)
+
+    Connection._sendExact = counted_send
+
+
+def log_instrumentation_summary(logger):
+    from tabulate import tabulate
+
+    summary = instruments.summary()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+
+    headers = ['Stage', 'Count', 'Total [s]', 'Mean [ms]', *[f'p{p} [ms]' for p in PERCENTILES], 'Max [ms]']
+    stages = [
+        [stage, stats['count'], round(stats['total'], 3), ms(stats['mean']), *[ms(stats[f'p{p}']) for p in PERCENTILES], ms(stats['max'])]
+        for stage, stats in summary['stages'].items()
+    ]
+    logger.log('Stages:')
+    logger.log(lambda: tabulate(stages, headers=headers, tablefmt=table_style))
+    logger.log('Counters:')
+    logger.log(lambda: tabulate(summary['counters'].items(), headers=['Counter', 'Value'], tablefmt=table_style))
+
+
+def log_query_summary(logger, tracer):
+    from tabulate import tabulate
+
+    summary = tracer.summary()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+
+    headers = ['Function', 'Calls', 'Total [s]', 'Mean [ms]', *[f'p{p} [ms]' for p in PERCENTILES], 'Max [ms]', 'Rows', 'Slow']
+    functions = [
+        [function, stats['calls'], round(stats['total_time'], 3), ms(stats['mean_time']), *[ms(stats[f'p{p}_time']) for p in PERCENTILES], ms(stats['max_time']), stats['rows'], stats['slow_calls']]
+        for function, stats in summary['functions'].items()
+    ]
+    logger.event('database_queries', **summary)
+    logger.log('Database queries:')
+    logger.log(lambda: tabulate(functions, headers=headers, tablefmt=table_style))
+
+
 def read_true_target(vehicle, users):
-    return users.xpath(f'./user/trips/trip[@id="{vehicle}"]')[0].attrib['target']
+    return users.target_of(vehicle)
+
+
+def recommend(advisor, request, true_target):
+    """ DB- and routing-bound part of guiding a single vehicle; issues no TraCI commands. """
+    advisor.suggest_targets(request)
+    advisor.pick_parking_areas(request, true_target)
+    return request
+
+
+def send_to_parking_area(vehicle, parking_areas, parkings):
+    """ Stops vehicle at the first of recommended parking areas which accepts it; returns that area, or None. """
+    import traci
+    from traci.exceptions import TraCIException
 
+    for parking_area in parking_areas:
+        traci.vehicle.setVia(vehicle, parkings.edge_of(parking_area))
+        traci.vehicle.rerouteTraveltime(vehicle)
+        try:
+            traci.vehicle.setParkingAreaStop(vehicle, parking_area, duration=random.randint(MIN_STOP_TIME_SEC, MAX_STOP_TIME_SEC))
+            return parking_area
+        except TraCIException:
+            instruments.count('driver.rejected_stops')
 
-def guide_vehicles(advisor, users, parking_tree, gui, logger):
-    new_vehicle_ids = traci.simulation.getDepartedIDList()
-    new_guided_vehicle_ids = [vehicle_id for vehicle_id in new_vehicle_ids if traci.vehicle.getTypeID(vehicle_id) == 'veh_guided']
+    return None
+
+
+def guide_vehicles(advisor, users, parkings, vehicle_states, gui, logger, executor=None):
+    import traci
+
+    new_guided_vehicle_ids = vehicle_states.departed_guided
+
+    requests = [advisor.new_request(guided_veh) for guided_veh in new_guided_vehicle_ids]
+    true_targets = [read_true_target(guided_veh, users) for guided_veh in new_guided_vehicle_ids]
+
+    with instruments.stage('driver.recommendations'):
+        if executor is not None and len(requests) > 1:
+            requests = list(executor.map(recommend, [advisor] * len(requests), requests, true_targets))
+        else:
+            requests = [recommend(advisor, request, true_target) for request, true_target in zip(requests, true_targets)]
     
-    for guided_veh in new_guided_vehicle_ids:
+    for request, true_target in zip(requests, true_targets):
+        guided_veh = request.vehicle
         traci.vehicle.highlight(guided_veh)
-        
-        suggested_targets = advisor.suggest_targets(guided_veh)
-        true_target = read_true_target(guided_veh, users)
-        evaluate_target_suggestions(guided_veh, true_target, suggested_targets, advisor, logger)
-
-        parking_areas = advisor.pick_parking_areas(guided_veh, true_target)
-
-        log_weights_summary(logger, advisor)
-        log_costs_summary(logger, advisor, parking_areas)
-        for parking_area in parking_areas:
-            parking_area_elem = parking_tree.xpath(f'./parkingArea[@id="{parking_area}"]')[0]
-            traci.vehicle.setVia(guided_veh, parking_area_elem.attrib['lane'].split('_')[0])
-            traci.vehicle.rerouteTraveltime(guided_veh)
-            try:
-                traci.vehicle.setParkingAreaStop(guided_veh, parking_area, duration=random.randint(MIN_STOP_TIME_SEC, MAX_STOP_TIME_SEC))
-                logger.log(f'Sending vehicle {guided_veh} to parking {parking_area}\n')
-                break
-            except TraCIException:
-                pass
+
+        with instruments.stage('driver.logging'):
+            evaluate_target_suggestions(request, true_target, logger)
+            log_weights_summary(logger, request)
+            log_costs_summary(logger, request)
+
+        with instruments.stage('driver.traci_reroute'):
+            parking_area = send_to_parking_area(guided_veh, request.parking_areas, parkings)
+
+        if parking_area is not None:
+            logger.event('assignment', vehicle=guided_veh, parking_area=parking_area)
+            logger.log(f'Sending vehicle {guided_veh} to parking {parking_area}\n')
         else:
-            logger.log(f'WARNING: Failed to send vehicle {guided_veh} to applicable parking area\n')        
+            logger.event('assignment', level=WARNING, vehicle=guided_veh, parking_area=None)
+            logger.log(f'WARNING: Failed to send vehicle {guided_veh} to applicable parking area\n', WARNING)        
 
     if gui and new_guided_vehicle_ids:
         traci.gui.trackVehicle('View #0', new_guided_vehicle_ids[0])
@@ -123,6 +220,8 @@ def guide_vehicles(advisor, users, parking_tree, gui, logger):
 @click.option('--gui/--headless', default=True, help='Run simulation with/without GUI.')
 @click.option('-q', '--quiet', default=False, help='Silence log output in terminal.', is_flag=True)
 @click.option('-o', '--output', default='', help='File to which log should be saved.')
+@click.option('--log-level', default='info', type=click.Choice(list(LEVELS)), help='Lowest level of logged messages.')
+@click.option('--json-log', default='', help='File to which structured log (JSON lines) should be saved.')
 @click.option('-c', '--continue', 'continue_', default=False, is_flag=True, help='Continue simulation from when it ended during last run.')
 @click.option('-w', '--week', default=1, help='Week at which simulation starts (positive integer).')
 @click.option('-d', '--day', default=1, help='Day of week at which simulation starts (1-7).')
@@ -130,19 +229,50 @@ def guide_vehicles(advisor, users, parking_tree, gui, logger):
 @click.option('--clear', default=False, is_flag=True, help='Cleares users history and stored simulation time.')
 @click.option('--weather', default=None, type=float, help='Weather conditions in simulation run (float from [0.,1.], 0 - terrible weather, 1 - perfect weather).')
 @click.option('--air-quality', default=None, type=float, help='Air quality in simulation run (float from [0.,1.], 0 - terrible quality, 1 - perfect quality).')
-def main(gui, quiet, output, continue_, week, day, time, clear, weather, air_quality):
-    if gui:
-        traci.start(['sumo-gui', '-c', sumocfg_path])
-    else:
-        traci.start(['sumo', '-c', sumocfg_path, '--no-warnings'])
-
-    users = ET.parse(users_file)
-    parking_tree = ET.parse(parkings_file)
-
-    time_controller = TimeController(continue_, week, day, time)
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of threads preparing recommendations for vehicles departing in the same step.')
+@click.option('--seed', default=None, type=int, help='Seed of random generators of SUMO and of the advisor.')
+@click.option('--traci-port', default=None, type=int, help='Port of TraCI connection (free port is picked by default).')
+@click.option('--label', default=None, help='Name of this run: label of its TraCI connection and suffix of its stored simulation time.')
+@click.option('--db-schema', default=None, help='Database schema searched before public, e.g. with private user history.')
+@click.option('--db-connections', default=DB_POOL_MAX_CONN, type=click.IntRange(min=1), show_default=True, help='Maximum number of database connections of this run.')
+@click.option('--metrics', default='', help='Enables per-stage timers and counters and saves their summary (JSON) to given file.')
+@trace_options
+def main(gui, quiet, output, log_level, json_log, continue_, week, day, time, clear, weather, air_quality, workers, seed, traci_port, label, db_schema, db_connections, metrics, tracer):
+    add_sumo_tools_to_path()
+    if metrics:
+        instruments.enable()
+        count_traci_calls()
+
+    from concurrent.futures import ThreadPoolExecutor
+    import traci
+    from traci.exceptions import FatalTraCIError
+    from parking_advisor import ParkingAdvisor
+    from time_controller import TimeController, time_file
+    from database import shared_database, configure_shared_database
+    from parking_registry import ParkingRegistry
+    from occupancy import OccupancyTracker
+    from vehicle_state import VehicleStates
+    from users_model import UsersModel
+
+    if seed is not None:
+        random.seed(seed)
+    configure_shared_database(schema=db_schema, max_connections=db_connections)
+
+    sumo_cmd = ['sumo-gui', '-c', sumocfg_path] if gui else ['sumo', '-c', sumocfg_path, '--no-warnings']
+    if seed is not None:
+        sumo_cmd += ['--seed', str(seed)]
+    traci.start(sumo_cmd, port=traci_port, label=label or 'default')
+
+    users = UsersModel.cached()
+    parkings = ParkingRegistry.cached()
+
+    time_controller = TimeController(continue_, week, day, time, f'{time_file}.{label}' if label else time_file)
     environment = Environment(weather, air_quality)
-    advisor = ParkingAdvisor(time_controller, environment)
-    logger = Logger(quiet, output)
+    occupancy = OccupancyTracker(parkings)
+    vehicle_states = VehicleStates(users.trip_ids)
+    advisor = ParkingAdvisor(time_controller, environment, parkings, occupancy, vehicle_states, users)
+    logger = Logger(quiet, output, LEVELS[log_level], json_log)
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
     step = 0
 
     if clear:
@@ -152,18 +282,36 @@ def main(gui, quiet, output, continue_, week, day, time, clear, weather, air_qua
 
     try:
         while traci.simulation.getMinExpectedNumber() > 0:
-            traci.simulationStep()
-            time_controller.update_curr_time(traci.simulation.getTime())
-            guide_vehicles(advisor, users, parking_tree, gui, logger)
+            with instruments.stage('driver.step'):
+                with instruments.stage('driver.simulation_step'):
+                    traci.simulationStep()
+                    time_controller.update_curr_time(traci.simulation.getTime())
+                with instruments.stage('driver.subscriptions'):
+                    occupancy.update()
+                    vehicle_states.update()
+                guide_vehicles(advisor, users, parkings, vehicle_states, gui, logger, executor)
             step += 1
+        # Marks the structured log as complete; runs without it are treated as failed by experiments.py.
+        logger.event('run_end', steps=step, sim_time=traci.simulation.getTime())
 
     except FatalTraCIError as e:
         print(f'simulation interrupted (stopped by TraCI) at step {step}')
         print(e)
-        return -1
+        sys.exit(1)
 
     finally:
+        if executor is not None:
+            executor.shutdown()
+        advisor.close()
         time_controller.save_time()
+        log_pool_summary(logger)
+        if metrics:
+            log_instrumentation_summary(logger)
+            instruments.dump(metrics)
+        if tracer is not None:
+            log_query_summary(logger, tracer)
+        logger.close()
+        shared_database().close()
 
 
 if __name__ == '__main__':
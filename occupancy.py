@@ -0,0 +1,38 @@
+import numpy as np
+import traci
+import traci.constants as tc
+
+
+class OccupancyTracker:
+    """ Number of vehicles parked in every parking area, refreshed from TraCI subscriptions.
+
+    All parking areas are subscribed once; `update` must be called after every
+    simulation step and only reads the results SUMO sent with the step.
+    """
+
+    def __init__(self, parkings):
+        self._parkings = parkings
+        self._occupied = np.zeros(len(parkings), dtype=np.int32)
+        self._total_occupied = 0
+        self._total_capacity = parkings.total_capacity
+
+        for parking_id in parkings.ids:
+            traci.parkingarea.subscribe(parking_id, (tc.VAR_STOP_STARTING_VEHICLES_NUMBER,))
+        self.update()
+
+
+    def update(self):
+        for parking_id, values in traci.parkingarea.getAllSubscriptionResults().items():
+            i = self._parkings.index(parking_id)
+            n_vehicles = int(values[tc.VAR_STOP_STARTING_VEHICLES_NUMBER])
+            self._total_occupied += n_vehicles - int(self._occupied[i])
+            self._occupied[i] = n_vehicles
+
+
+    def free_spots(self, parking_id):
+        i = self._parkings.index(parking_id)
+        return int(self._parkings.capacity[i]) - int(self._occupied[i])
+
+
+    def global_free_ratio(self):
+        return (self._total_capacity - self._total_occupied) / self._total_capacity
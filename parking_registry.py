@@ -0,0 +1,110 @@
+import os
+import numpy as np
+from lxml import etree as ET
+
+
+from snapshot import load_snapshot, str_array
+from constants import *
+
+
+parkings_file = os.path.join(sumo_rel_path, gen_subdir, parkings_gen_filename)
+
+
+class ParkingRegistry:
+    """ Parking areas from parkings.add.xml, stored column-wise under dense integer indices.
+
+    Capacity follows SUMO: roadsideCapacity plus the number of explicitly
+    defined spaces. Space geometry of parking area i is
+    `space_xy[space_offsets[i]:space_offsets[i + 1]]` (x, y, width, length).
+    """
+
+    __slots__ = ('ids', 'lanes', 'edges', 'capacity', 'start_pos', 'end_pos', 'angle', 'space_offsets', 'space_xy', '_index')
+
+    def __init__(self, ids, lanes, capacity, start_pos, end_pos, angle, space_offsets, space_xy):
+        self.ids = list(ids)
+        self.lanes = list(lanes)
+        self.edges = [lane.rsplit('_', 1)[0] for lane in self.lanes]
+        self.capacity = np.asarray(capacity, dtype=np.int32)
+        self.start_pos = np.asarray(start_pos, dtype=np.float64)
+        self.end_pos = np.asarray(end_pos, dtype=np.float64)
+        self.angle = np.asarray(angle, dtype=np.float64)
+        self.space_offsets = np.asarray(space_offsets, dtype=np.int64)
+        self.space_xy = np.asarray(space_xy, dtype=np.float64).reshape(-1, 4)
+        self._index = {parking_id: i for i, parking_id in enumerate(self.ids)}
+
+
+    @classmethod
+    def load(cls, path=parkings_file):
+        ids, lanes, capacity, start_pos, end_pos, angle = [], [], [], [], [], []
+        space_offsets, space_xy = [0], []
+
+        for _, parking in ET.iterparse(path, events=('end',), tag='parkingArea'):
+            spaces = [[float(space.attrib.get(k, 0.)) for k in ('x', 'y', 'width', 'length')] for space in parking.iterfind('space')]
+
+            ids.append(parking.attrib['id'])
+            lanes.append(parking.attrib['lane'])
+            capacity.append(int(parking.attrib.get('roadsideCapacity', 0)) + len(spaces))
+            start_pos.append(float(parking.attrib.get('startPos', 0.)))
+            end_pos.append(float(parking.attrib.get('endPos', 0.)))
+            angle.append(float(parking.attrib.get('angle', 0.)))
+            space_xy.extend(spaces)
+            space_offsets.append(len(space_xy))
+
+            parking.clear()
+
+        return cls(ids, lanes, capacity, start_pos, end_pos, angle, space_offsets, space_xy)
+
+
+    @classmethod
+    def cached(cls, path=parkings_file):
+        """ Same as `load`, but read from a snapshot while the file is unchanged. """
+        return load_snapshot('parkings', [path], lambda: cls.load(path), cls.to_arrays, cls.from_arrays)
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(
+            arrays['ids'].tolist(), arrays['lanes'].tolist(), arrays['capacity'], arrays['start_pos'], arrays['end_pos'],
+            arrays['angle'], arrays['space_offsets'], arrays['space_xy']
+        )
+
+
+    def to_arrays(self):
+        return {
+            'ids': str_array(self.ids), 'lanes': str_array(self.lanes), 'capacity': self.capacity, 'start_pos': self.start_pos,
+            'end_pos': self.end_pos, 'angle': self.angle, 'space_offsets': self.space_offsets, 'space_xy': self.space_xy
+        }
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def __contains__(self, parking_id):
+        return parking_id in self._index
+
+
+    @property
+    def total_capacity(self):
+        return int(self.capacity.sum())
+
+
+    def index(self, parking_id):
+        return self._index[parking_id]
+
+
+    def capacity_of(self, parking_id):
+        return int(self.capacity[self._index[parking_id]])
+
+
+    def lane_of(self, parking_id):
+        return self.lanes[self._index[parking_id]]
+
+
+    def edge_of(self, parking_id):
+        return self.edges[self._index[parking_id]]
+
+
+    def spaces_of(self, parking_id):
+        i = self._index[parking_id]
+        return self.space_xy[self.space_offsets[i]:self.space_offsets[i + 1]]
@@ -0,0 +1,166 @@
+import functools
+import json
+import re
+import threading
+import click
+
+
+from instrumentation import Histogram, PERCENTILES
+from constants import *
+
+
+# Set-returning function in FROM (get_nearby_buildings(...)), else first call in select list other than PostGIS ST_*.
+_FROM_FUNCTION = re.compile(r'\bfrom\s+(\w+)\s*\(', re.IGNORECASE)
+_SELECT_FUNCTION = re.compile(r'^\s*select\b(?:(?!\bfrom\b).)*?\b(?!st_)(\w+)\s*\(', re.IGNORECASE | re.DOTALL)
+
+_PLAN_SAVEPOINT = 'query_tracer_plan'
+
+
+def called_function(sql):
+    """ Name of the database function a statement calls, or None if it calls none. """
+    match = _FROM_FUNCTION.search(sql) or _SELECT_FUNCTION.search(sql)
+    return match.group(1).lower() if match else None
+
+
+class FunctionStats:
+    """ Calls of one database function (or of one statement that calls none). """
+
+    __slots__ = ('statements', 'times', 'rows', 'slow_calls', 'plans', 'plans_reserved')
+
+    def __init__(self):
+        self.statements = set()
+        self.times = Histogram()
+        self.rows = 0
+        self.slow_calls = 0
+        self.plans = []
+        self.plans_reserved = 0
+
+
+    def summary(self):
+        times = self.times.summary()
+        return {
+            'statements': sorted(self.statements),
+            'calls': times['count'],
+            'total_time': times['total'],
+            'mean_time': times['mean'],
+            **{f'p{p}_time': times[f'p{p}'] for p in PERCENTILES},
+            'max_time': times['max'],
+            'rows': self.rows,
+            'mean_rows': self.rows / times['count'] if times['count'] else None,
+            'slow_calls': self.slow_calls,
+            'plans': self.plans
+        }
+
+
+class QueryTracer:
+    """ Wall time and row count of every query, aggregated per called database function.
+
+    Most queries only call plpgsql functions from setup_db.sql, so they are
+    grouped by that function rather than by statement. A query slower than
+    `slow_threshold` seconds is run once more as `EXPLAIN (ANALYZE, BUFFERS)`
+    (at most `max_plans` times per function), inside a savepoint which is
+    rolled back afterwards, so neither its side effects nor a failed EXPLAIN
+    affect the caller's transaction. With `calls_file` given, every call is
+    also written to it as a JSON line.
+    """
+
+    def __init__(self, summary_file, slow_threshold=DB_SLOW_QUERY_SEC, max_plans=DB_MAX_PLANS_PER_FUNCTION, calls_file=''):
+        self._summary_file = summary_file
+        self._slow_threshold = slow_threshold
+        self._max_plans = max_plans
+        self._calls = open(calls_file, 'w', buffering=1 << 16) if calls_file else None
+
+        self._lock = threading.Lock()
+        self._functions = {}
+
+
+    def trace(self, cur, statement, sql, params, wall_time, explain_sql):
+        """ Records query just executed on cursor; explain_sql repeats it (with the same params) under EXPLAIN. """
+        function = called_function(sql) or statement
+        rows = cur.rowcount if cur.rowcount >= 0 else 0
+        is_slow = wall_time >= self._slow_threshold
+
+        with self._lock:
+            stats = self._functions.get(function)
+            if stats is None:
+                stats = self._functions[function] = FunctionStats()
+            stats.statements.add(statement)
+            stats.times.record(wall_time)
+            stats.rows += rows
+            capture_plan = is_slow and stats.plans_reserved < self._max_plans
+            if is_slow:
+                stats.slow_calls += 1
+            if capture_plan:
+                stats.plans_reserved += 1
+            if self._calls is not None:
+                self._calls.write(json.dumps({'function': function, 'statement': statement, 'params': list(params or ()), 'wall_time': wall_time, 'rows': rows}, default=str) + '\n')
+
+        if capture_plan:
+            plan = self._explain(cur.connection, explain_sql, params)
+            with self._lock:
+                stats.plans.append({'statement': statement, 'params': [str(param) for param in params or ()], 'wall_time': wall_time, 'rows': rows, 'plan': plan})
+
+
+    def summary(self):
+        """ Per-function statistics, the most time consuming function first. """
+        with self._lock:
+            ranked = sorted(self._functions.items(), key=lambda item: item[1].times.total, reverse=True)
+            return {'slow_threshold': self._slow_threshold, 'functions': {function: stats.summary() for function, stats in ranked}}
+
+
+    def close(self):
+        """ Writes the summary; further queries are no longer traced to the calls file. """
+        with self._lock:
+            calls, self._calls = self._calls, None
+        if calls is not None:
+            calls.close()
+
+        with open(self._summary_file, 'w') as out:
+            json.dump(self.summary(), out, indent=4, default=str)
+
+
+    def _explain(self, conn, explain_sql, params):
+        with conn.cursor() as cur:
+            cur.execute(f'SAVEPOINT {_PLAN_SAVEPOINT}')
+            try:
+                cur.execute(explain_sql, params)
+                plan = [row[0] for row in cur.fetchall()]
+            except Exception as error:
+                plan = [f'EXPLAIN failed: {error}']
+            cur.execute(f'ROLLBACK TO SAVEPOINT {_PLAN_SAVEPOINT}')
+            cur.execute(f'RELEASE SAVEPOINT {_PLAN_SAVEPOINT}')
+        return plan
+
+
+def trace_shared_database(summary_file, slow_threshold=DB_SLOW_QUERY_SEC, calls_file=''):
+    """ Makes the shared database pool report its queries to a new tracer, which is returned. """
+    from database import configure_shared_database
+
+    tracer = QueryTracer(summary_file, slow_threshold, calls_file=calls_file)
+    configure_shared_database(tracer=tracer)
+    return tracer
+
+
+def trace_options(command):
+    """ Adds --trace-queries, --trace-calls and --slow-query-ms to a click command (or group).
+
+    Apply it below the click decorators. With --trace-queries the shared
+    database is traced while the command (with its subcommands) runs and the
+    summary is written when its context closes; the command gets the tracer,
+    or None, as `tracer` argument.
+    """
+    @click.option('--trace-queries', default='', help='Traces database queries and saves their per-function summary (JSON) to given file.')
+    @click.option('--trace-calls', default='', help='With --trace-queries, also saves every traced query (JSON lines) to given file.')
+    @click.option('--slow-query-ms', default=DB_SLOW_QUERY_SEC * 1000, show_default=True, help='Queries slower than this (in milliseconds) get their plan captured in the trace.')
+    @functools.wraps(command)
+    def wrapper(*args, trace_queries, trace_calls, slow_query_ms, **kwargs):
+        if trace_calls and not trace_queries:
+            raise click.UsageError('--trace-calls requires --trace-queries.')
+
+        tracer = None
+        if trace_queries:
+            tracer = trace_shared_database(trace_queries, slow_query_ms / 1000, trace_calls)
+            click.get_current_context().call_on_close(tracer.close)
+        return command(*args, tracer=tracer, **kwargs)
+
+    return wrapper
@@ -0,0 +1,188 @@
+from heapq import heappush, heappop
+import hashlib
+from math import inf
+import numpy as np
+
+
+from spatial_index import GridIndex
+from constants import *
+
+
+DRIVING = 'driving'
+WALKING = 'walking'
+
+
+class RoadGraph:
+    """ In-process replacement for the pgr_dijkstraCost based estimated_* functions.
+
+    The ways/ways_vertices_pgr graph is loaded once into CSR adjacency (one per
+    cost profile), so a query is a single Dijkstra run without a database round trip.
+    Costs follow pgRouting conventions: a negative cost means the edge can't be
+    traversed in that direction. Buildings and parkings come with their nearest
+    vertex already resolved (see snap_static_points in setup_db.sql), while
+    vehicle positions are snapped through an in-memory grid index.
+    """
+
+    def __init__(self, vertex_ids, vertex_lon, vertex_lat, edges, building_vertices, parking_vertices):
+        self._vertex_ids = np.asarray(vertex_ids, dtype=np.int64)
+        self._vertex_lon = np.asarray(vertex_lon, dtype=np.float64)
+        self._vertex_lat = np.asarray(vertex_lat, dtype=np.float64)
+        self._vertex_index = {int(vertex_id): i for i, vertex_id in enumerate(self._vertex_ids)}
+        self._vertex_grid = GridIndex(self._vertex_lon, self._vertex_lat)
+
+        source, target, cost_s, reverse_cost_s, length_m = (np.asarray(column, dtype=np.float64) for column in edges)
+        source = self._to_indices(source)
+        target = self._to_indices(target)
+        walking_cost = length_m / WALKING_SPEED_MPS
+
+        self._csr = {
+            DRIVING: self._build_csr(source, target, cost_s, reverse_cost_s),
+            WALKING: self._build_csr(source, target, walking_cost, walking_cost)
+        }
+
+        self._building_vertex = self._to_index_map(building_vertices)
+        self._parking_vertex = self._to_index_map(parking_vertices)
+
+
+    @classmethod
+    def load(cls, db):
+        db.register('routing_vertices', 'select id, ST_X(the_geom), ST_Y(the_geom) from ways_vertices_pgr order by id')
+        db.register('routing_edges', 'select source, target, cost_s, reverse_cost_s, length_m from ways where source is not null and target is not null')
+        db.register('routing_buildings', 'select name, building_vertex(name) from buildings')
+        db.register('routing_parkings', 'select id, parking_vertex(id) from parkings')
+
+        vertices = db.fetch_all('routing_vertices')
+        edges = db.fetch_all('routing_edges')
+
+        return cls(
+            vertex_ids=[v[0] for v in vertices],
+            vertex_lon=[v[1] for v in vertices],
+            vertex_lat=[v[2] for v in vertices],
+            edges=list(zip(*edges)) if edges else ([], [], [], [], []),
+            building_vertices={b[0]: b[1] for b in db.fetch_all('routing_buildings')},
+            parking_vertices={p[0]: p[1] for p in db.fetch_all('routing_parkings')}
+        )
+
+
+    @property
+    def n_vertices(self):
+        return len(self._vertex_ids)
+
+
+    def fingerprint(self):
+        """ Digest of graph topology, costs and static point snapping, for invalidating derived data. """
+        digest = hashlib.sha1()
+        for array in (self._vertex_ids, self._vertex_lon, self._vertex_lat, *self._csr[DRIVING], *self._csr[WALKING]):
+            digest.update(array.tobytes())
+        digest.update(repr(sorted(self._building_vertex.items())).encode())
+        digest.update(repr(sorted(self._parking_vertex.items())).encode())
+        return digest.hexdigest()
+
+
+    def nearest_vertex(self, lon, lat):
+        """ Index of the vertex closest to given point (planar distance in EPSG:4326, as `<->` does). """
+        return self._vertex_grid.nearest(lon, lat)
+
+
+    def building_vertex(self, building):
+        return self._building_vertex.get(building)
+
+
+    def parking_vertex(self, parking):
+        return self._parking_vertex.get(parking)
+
+
+    def travel_time(self, building, lon, lat):
+        """ Same as SQL estimated_travel_time; None if building is unknown or unreachable. """
+        return self._single_cost(DRIVING, self.nearest_vertex(lon, lat), self.building_vertex(building))
+
+
+    def travel_times(self, buildings, lon, lat):
+        """ estimated_travel_time for many buildings at once, with a single one-to-many search. """
+        return self._many_costs(DRIVING, self.nearest_vertex(lon, lat), {building: self.building_vertex(building) for building in buildings})
+
+
+    def driving_time(self, parking, lon, lat):
+        """ Same as SQL estimated_driving_time; None if parking is unknown or unreachable. """
+        return self._single_cost(DRIVING, self.nearest_vertex(lon, lat), self.parking_vertex(parking))
+
+
+    def driving_times(self, parkings, lon, lat):
+        """ estimated_driving_time for many parkings at once, with a single one-to-many search. """
+        return self._many_costs(DRIVING, self.nearest_vertex(lon, lat), {parking: self.parking_vertex(parking) for parking in parkings})
+
+
+    def walking_time(self, parking, building):
+        """ Same as SQL estimated_walking_time; None if either end is unknown or unreachable. """
+        return self._single_cost(WALKING, self.parking_vertex(parking), self.building_vertex(building))
+
+
+    def costs_from(self, profile, source, targets=None):
+        """ One-to-many Dijkstra from vertex index `source`.
+
+        Returns dict {vertex index: aggregated cost}; the search stops once all
+        `targets` are settled (or explores the whole graph if targets is None).
+        """
+        indptr, indices, costs = self._csr[profile]
+        remaining = set(targets) if targets is not None else None
+
+        dist = {source: 0.}
+        settled = {}
+        heap = [(0., source)]
+
+        while heap:
+            d, vertex = heappop(heap)
+            if vertex in settled:
+                continue
+            settled[vertex] = d
+
+            if remaining is not None:
+                remaining.discard(vertex)
+                if not remaining:
+                    break
+
+            start, end = indptr[vertex], indptr[vertex + 1]
+            for neighbour, cost in zip(indices[start:end].tolist(), costs[start:end].tolist()):
+                candidate = d + cost
+                if candidate < dist.get(neighbour, inf):
+                    dist[neighbour] = candidate
+                    heappush(heap, (candidate, neighbour))
+
+        return settled
+
+
+    def _single_cost(self, profile, source, target):
+        if source is None or target is None:
+            return None
+        cost = self.costs_from(profile, source, [target]).get(target)
+        return int(round(cost)) if cost is not None else None
+
+
+    def _many_costs(self, profile, source, targets_by_key):
+        targets = {vertex for vertex in targets_by_key.values() if vertex is not None}
+        costs = self.costs_from(profile, source, targets) if targets else {}
+        return {key: int(round(costs[vertex])) if vertex in costs else None for key, vertex in targets_by_key.items()}
+
+
+    def _to_index_map(self, vertices_by_key):
+        return {key: self._vertex_index[int(vertex_id)] for key, vertex_id in vertices_by_key.items() if vertex_id is not None}
+
+
+    def _to_indices(self, vertex_ids):
+        return np.array([self._vertex_index[int(vertex_id)] for vertex_id in vertex_ids], dtype=np.int32)
+
+
+    def _build_csr(self, source, target, cost, reverse_cost):
+        forward = cost >= 0
+        backward = reverse_cost >= 0
+
+        tails = np.concatenate([source[forward], target[backward]])
+        heads = np.concatenate([target[forward], source[backward]])
+        weights = np.concatenate([cost[forward], reverse_cost[backward]])
+
+        order = np.argsort(tails, kind='stable')
+        indptr = np.zeros(self.n_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tails, minlength=self.n_vertices), out=indptr[1:])
+
+        return indptr, heads[order].astype(np.int32), weights[order].astype(np.float64)
+
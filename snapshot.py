@@ -0,0 +1,127 @@
+import hashlib
+import os
+import zipfile
+import numpy as np
+
+
+from constants import *
+
+
+# Bump whenever the layout of any stored snapshot changes.
+SNAPSHOT_VERSION = 1
+
+snapshot_dir = os.path.join(sumo_rel_path, gen_subdir)
+
+
+class SourceStamp:
+    """ Identity of a source file: mtime and size for a cheap check, content digest for a reliable one. """
+
+    __slots__ = ('path', 'mtime_ns', 'size', 'digest')
+
+    def __init__(self, path, mtime_ns, size, digest):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+
+
+    @classmethod
+    def of(cls, path):
+        stat = os.stat(path)
+        return cls(path, stat.st_mtime_ns, stat.st_size, file_digest(path))
+
+
+    def current(self, path):
+        """ Stamp of file at path if it still has the stamped content, else None; it is hashed only when mtime or size differ. """
+        stat = os.stat(path)
+        if stat.st_size != self.size:
+            return None
+        if stat.st_mtime_ns == self.mtime_ns:
+            return self
+        if file_digest(path) != self.digest:
+            return None
+        return SourceStamp(path, stat.st_mtime_ns, stat.st_size, self.digest)
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_path(name):
+    return os.path.join(snapshot_dir, name + snapshot_gen_suffix)
+
+
+def read_snapshot(path, sources):
+    """ Arrays stored in snapshot, or None if it is missing, damaged, of other version or built from other sources.
+
+    Sources which were only touched (same content, other mtime) are stamped
+    anew, so that they are not hashed again on every later read.
+    """
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['__version__']) != SNAPSHOT_VERSION or data['__sources__'].tolist() != [os.path.abspath(source) for source in sources]:
+                return None
+
+            stamps = [SourceStamp(source, mtime_ns, size, digest) for source, mtime_ns, size, digest in zip(sources, data['__mtimes__'].tolist(), data['__sizes__'].tolist(), data['__digests__'].tolist())]
+            current_stamps = [stamp.current(source) for stamp, source in zip(stamps, sources)]
+            if None in current_stamps:
+                return None
+
+            arrays = {key: data[key] for key in data.files if not key.startswith('__')}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+        print(error)
+        return None
+
+    if any(current is not stamp for current, stamp in zip(current_stamps, stamps)):
+        write_snapshot(path, sources, arrays, current_stamps)
+    return arrays
+
+
+def write_snapshot(path, sources, arrays, stamps=None):
+    stamps = stamps or [SourceStamp.of(source) for source in sources]
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+
+    try:
+        with open(tmp_path, 'wb') as out:
+            np.savez(
+                out,
+                __version__=np.array(SNAPSHOT_VERSION),
+                __sources__=np.array([os.path.abspath(source) for source in sources], dtype=np.str_),
+                __mtimes__=np.array([stamp.mtime_ns for stamp in stamps], dtype=np.int64),
+                __sizes__=np.array([stamp.size for stamp in stamps], dtype=np.int64),
+                __digests__=np.array([stamp.digest for stamp in stamps], dtype=np.str_),
+                **arrays
+            )
+        os.replace(tmp_path, path)
+    except OSError as error:
+        print(f'Cannot store snapshot {path}: {error}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_snapshot(name, sources, build, to_arrays, from_arrays):
+    """ Object compiled from source files, read from its snapshot or built (and stored) when the snapshot is stale.
+
+    `build()` compiles the object from sources; `to_arrays(obj)` and
+    `from_arrays(arrays)` convert it to and from a dict of NumPy arrays.
+    """
+    path = snapshot_path(name)
+
+    arrays = read_snapshot(path, sources)
+    if arrays is not None:
+        return from_arrays(arrays)
+
+    obj = build()
+    write_snapshot(path, sources, to_arrays(obj))
+    return obj
+
+
+def str_array(values):
+    return np.array(values, dtype=np.str_)
@@ -0,0 +1,71 @@
+import math
+import numpy as np
+
+
+class GridIndex:
+    """ Uniform grid over a static point set, answering nearest-point queries.
+
+    Points are bucketed into square cells, stored cell by cell (CSR-like),
+    and a query scans rings of cells around the query cell until no unseen
+    cell can contain a closer point. Distances are planar.
+    """
+
+    def __init__(self, xs, ys, points_per_cell=2):
+        self._xs = np.asarray(xs, dtype=np.float64)
+        self._ys = np.asarray(ys, dtype=np.float64)
+        if len(self._xs) == 0:
+            raise ValueError('GridIndex requires at least one point')
+
+        self._x0, self._y0 = self._xs.min(), self._ys.min()
+        width = max(self._xs.max() - self._x0, 1e-12)
+        height = max(self._ys.max() - self._y0, 1e-12)
+        self._cell = max(math.sqrt(width * height * points_per_cell / len(self._xs)), 1e-12)
+
+        self._nx = int(width // self._cell) + 1
+        self._ny = int(height // self._cell) + 1
+
+        cell_ids = self._cell_y(self._ys) * self._nx + self._cell_x(self._xs)
+        self._order = np.argsort(cell_ids, kind='stable')
+        self._cell_start = np.searchsorted(cell_ids[self._order], np.arange(self._nx * self._ny + 1))
+
+
+    def nearest(self, x, y):
+        """ Index (into the original point arrays) of the point closest to (x, y). """
+        cx = int(self._cell_x(np.float64(x)))
+        cy = int(self._cell_y(np.float64(y)))
+
+        best, best_dist = None, math.inf
+        for r in range(max(self._nx, self._ny) + 1):
+            candidates = self._ring_points(cx, cy, r)
+            if len(candidates):
+                dists = (self._xs[candidates] - x)**2 + (self._ys[candidates] - y)**2
+                i = int(np.argmin(dists))
+                if dists[i] < best_dist:
+                    best, best_dist = int(candidates[i]), float(dists[i])
+
+            # every cell of ring r + 1 is at least r cells away from the query point
+            if best is not None and best_dist <= (r * self._cell)**2:
+                break
+
+        return best
+
+
+    def _cell_x(self, x):
+        return np.clip(((x - self._x0) // self._cell).astype(np.int64), 0, self._nx - 1)
+
+
+    def _cell_y(self, y):
+        return np.clip(((y - self._y0) // self._cell).astype(np.int64), 0, self._ny - 1)
+
+
+    def _ring_points(self, cx, cy, r):
+        cells = []
+        for iy in range(max(cy - r, 0), min(cy + r, self._ny - 1) + 1):
+            if abs(iy - cy) == r:
+                row = range(max(cx - r, 0), min(cx + r, self._nx - 1) + 1)
+            else:
+                row = [ix for ix in (cx - r, cx + r) if 0 <= ix < self._nx]
+            cells.extend(iy * self._nx + ix for ix in row)
+
+        slices = [self._order[self._cell_start[c]:self._cell_start[c + 1]] for c in cells]
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
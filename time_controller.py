@@ -8,7 +8,8 @@ time_file = os.path.join('.tmp', 'time')
 
 
 class TimeController:
-    def __init__(self, continue_, week, day, time):
+    def __init__(self, continue_, week, day, time, time_file=time_file):
+        self._time_file = time_file
         if continue_:
             self.start_time = self._restore_last_known_time()
         else:
@@ -45,16 +46,16 @@ class TimeController:
 
 
     def save_time(self):
-        with open(time_file, 'w') as tf:
+        with open(self._time_file, 'w') as tf:
             tf.write(str(self.start_time))
 
 
     def clear_stored_time(self):
-        open(time_file, 'w').close()
+        open(self._time_file, 'w').close()
 
 
     def _restore_last_known_time(self):
-        with open(time_file, 'r') as tf:
+        with open(self._time_file, 'r') as tf:
             content = tf.read()
             if content:
                 return int(content)
@@ -0,0 +1,116 @@
+import heapq
+import tempfile
+from lxml import etree as ET
+
+
+from constants import *
+
+
+class AliasTable:
+    """ Vose's alias table: draws index i with probability weights[i] / sum(weights) in O(1).
+
+    Built once in O(n), so assigning a parking area to every trip costs two
+    random numbers instead of a scan of cumulative weights.
+    """
+
+    __slots__ = ('_prob', '_alias', '_n')
+
+    def __init__(self, weights):
+        weights = [float(w) for w in weights]
+        total = sum(weights)
+        if not weights or total <= 0:
+            raise ValueError('alias table needs at least one positive weight')
+
+        self._n = n = len(weights)
+        scaled = [w * n / total for w in weights]
+        self._prob = [1.] * n
+        self._alias = list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1.]
+        large = [i for i, p in enumerate(scaled) if p >= 1.]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] -= 1. - scaled[s]
+            (small if scaled[l] < 1. else large).append(l)
+        # Whatever is left has probability 1 up to rounding errors.
+
+
+    def sample(self, rng):
+        i = int(rng.random() * self._n)
+        return i if rng.random() < self._prob[i] else self._alias[i]
+
+
+def read_root(path):
+    """ (tag, attributes, namespaces) of the root element of an XML file, read without parsing the rest. """
+    for _, root in ET.iterparse(path, events=('start',)):
+        return root.tag, dict(root.attrib), dict(root.nsmap)
+
+
+def iter_children(path):
+    """ Top-level elements (trips, vTypes, ...) of an XML file, one at a time.
+
+    Every element is detached from the root before it is yielded, so it is
+    freed as soon as the consumer drops it.
+    """
+    depth = 0
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            elem.getparent().remove(elem)
+            elem.tail = None
+            yield elem
+
+
+def depart_of(element):
+    """ Sort key of route file elements: departure time of trips; other elements (e.g. vTypes) go first. """
+    return float(element.attrib['depart']) if element.tag == 'trip' else 0.0
+
+
+def _write_run(run, directory):
+    with tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.run', delete=False) as out:
+        for key, data in run:
+            out.write(f'{key!r} {len(data)}\n'.encode())
+            out.write(data)
+        return out.name
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        for header in iter(f.readline, b''):
+            key, size = header.split()
+            yield float(key), f.read(int(size))
+
+
+def sorted_by_depart(elements, chunk_size=TRIP_SORT_CHUNK_SIZE, key=depart_of):
+    """ Elements ordered by key (stable), using at most chunk_size of them in memory.
+
+    Elements are serialized into runs of chunk_size, each sorted and spilled
+    to a temporary file, then the runs are merged. If everything fits in one
+    run, nothing is written to disk.
+    """
+    with tempfile.TemporaryDirectory(prefix='trips-sort-') as directory:
+        run_paths = []
+        run = []
+        for element in elements:
+            run.append((key(element), ET.tostring(element)))
+            if len(run) >= chunk_size:
+                run.sort(key=lambda record: record[0])
+                run_paths.append(_write_run(run, directory))
+                run = []
+        run.sort(key=lambda record: record[0])
+
+        if not run_paths:
+            for _, data in run:
+                yield ET.fromstring(data)
+            return
+
+        # heapq.merge prefers earlier runs on ties, so elements with equal keys keep their input order.
+        runs = [_read_run(path) for path in run_paths] + [iter(run)]
+        for _, data in heapq.merge(*runs, key=lambda record: record[0]):
+            yield ET.fromstring(data)
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+from lxml import etree as ET
+
+
+from snapshot import load_snapshot, str_array
+from constants import *
+
+
+users_file = os.path.join(sumo_rel_path, config_subdir, users_conf_filename)
+
+
+class UsersModel:
+    """ Users from users.xml: an index of their trips and their calendars.
+
+    Trip i is `(trip_user[i], trip_target[i], trip_time[i])`, found by id in
+    O(1). Calendar of the user with dense index u is
+    `calendar_times[calendar_offsets[u]:calendar_offsets[u + 1]]` (time of
+    week, ascending) with the matching slice of `calendar_places`.
+    """
+
+    __slots__ = ('user_ids', 'calendar_offsets', 'calendar_times', 'calendar_places', 'trip_ids', 'trip_user', 'trip_target', 'trip_time', '_user_index', '_trip_index')
+
+    def __init__(self, user_ids, calendar_offsets, calendar_times, calendar_places, trip_ids, trip_user, trip_target, trip_time):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.calendar_offsets = np.asarray(calendar_offsets, dtype=np.int64)
+        self.calendar_times = np.asarray(calendar_times, dtype=np.int64)
+        self.calendar_places = list(calendar_places)
+        self.trip_ids = list(trip_ids)
+        self.trip_user = np.asarray(trip_user, dtype=np.int64)
+        self.trip_target = list(trip_target)
+        self.trip_time = np.asarray(trip_time, dtype=np.int64)
+        self._user_index = {user_id: u for u, user_id in enumerate(self.user_ids.tolist())}
+        self._trip_index = {trip_id: i for i, trip_id in enumerate(self.trip_ids)}
+
+
+    @classmethod
+    def load(cls, path=users_file):
+        user_ids, calendar_offsets, calendar_times, calendar_places = [], [0], [], []
+        trip_ids, trip_user, trip_target, trip_time = [], [], [], []
+
+        for _, user in ET.iterparse(path, events=('end',), tag='user'):
+            user_id = int(user.attrib['id'])
+
+            events = sorted((DAYS.index(event.attrib['day']) * DAY_LEN_SECONDS + int(event.attrib['time']), event.attrib['place']) for event in user.iterfind('calendar/event'))
+            user_ids.append(user_id)
+            calendar_times.extend(time_of_week for time_of_week, _ in events)
+            calendar_places.extend(place for _, place in events)
+            calendar_offsets.append(len(calendar_times))
+
+            for trip in user.iterfind('trips/trip'):
+                trip_ids.append(trip.attrib['id'])
+                trip_user.append(user_id)
+                trip_target.append(trip.attrib['target'])
+                trip_time.append(int(trip.attrib['time']))
+
+            user.clear()
+
+        return cls(user_ids, calendar_offsets, calendar_times, calendar_places, trip_ids, trip_user, trip_target, trip_time)
+
+
+    @classmethod
+    def cached(cls, path=users_file):
+        """ Same as `load`, but read from a snapshot while the file is unchanged. """
+        return load_snapshot('users', [path], lambda: cls.load(path), cls.to_arrays, cls.from_arrays)
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(
+            arrays['user_ids'], arrays['calendar_offsets'], arrays['calendar_times'], arrays['calendar_places'].tolist(),
+            arrays['trip_ids'].tolist(), arrays['trip_user'], arrays['trip_target'].tolist(), arrays['trip_time']
+        )
+
+
+    def to_arrays(self):
+        return {
+            'user_ids': self.user_ids, 'calendar_offsets': self.calendar_offsets, 'calendar_times': self.calendar_times,
+            'calendar_places': str_array(self.calendar_places), 'trip_ids': str_array(self.trip_ids), 'trip_user': self.trip_user,
+            'trip_target': str_array(self.trip_target), 'trip_time': self.trip_time
+        }
+
+
+    def __len__(self):
+        return len(self.user_ids)
+
+
+    def __contains__(self, trip_id):
+        return trip_id in self._trip_index
+
+
+    def trip(self, trip_id):
+        """ (user id, target building, departure time) of a trip. """
+        i = self._trip_index[trip_id]
+        return int(self.trip_user[i]), self.trip_target[i], int(self.trip_time[i])
+
+
+    def target_of(self, trip_id):
+        return self.trip_target[self._trip_index[trip_id]]
+
+
+    def calendar(self, user_id):
+        """ (time of week, place) of every calendar event of a user, ordered by time of week. """
+        u = self._user_index.get(user_id)
+        if u is None:
+            return []
+
+        start, end = self.calendar_offsets[u], self.calendar_offsets[u + 1]
+        return list(zip(self.calendar_times[start:end].tolist(), self.calendar_places[start:end]))
+
+
+    def calendar_places_of(self, user_id):
+        u = self._user_index.get(user_id)
+        if u is None:
+            return []
+        return self.calendar_places[self.calendar_offsets[u]:self.calendar_offsets[u + 1]]
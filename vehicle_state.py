@@ -0,0 +1,81 @@
+import traci
+import traci.constants as tc
+
+
+class GeoTransform:
+    """ Affine map from network (x, y) to (lon, lat), fitted to convertGeo at three corners of the net boundary.
+
+    Over a city-sized network the projection differs from an affine map by
+    well under a metre, so positions are converted locally instead of with a
+    convertGeo round trip per vehicle.
+    """
+
+    __slots__ = ('_x0', '_y0', '_lon0', '_lat0', '_lon_x', '_lon_y', '_lat_x', '_lat_y')
+
+    def __init__(self, points, geo_points):
+        (x0, y0), (x1, _), (_, y2) = points
+        (lon0, lat0), (lon1, lat1), (lon2, lat2) = geo_points
+        dx = (x1 - x0) or 1.
+        dy = (y2 - y0) or 1.
+
+        self._x0, self._y0, self._lon0, self._lat0 = x0, y0, lon0, lat0
+        self._lon_x, self._lon_y = (lon1 - lon0) / dx, (lon2 - lon0) / dy
+        self._lat_x, self._lat_y = (lat1 - lat0) / dx, (lat2 - lat0) / dy
+
+
+    @classmethod
+    def from_simulation(cls):
+        (x_min, y_min), (x_max, y_max) = traci.simulation.getNetBoundary()
+        points = [(x_min, y_min), (x_max, y_min), (x_min, y_max)]
+        return cls(points, [traci.simulation.convertGeo(x, y) for x, y in points])
+
+
+    def __call__(self, x, y):
+        dx, dy = x - self._x0, y - self._y0
+        return self._lon0 + self._lon_x * dx + self._lon_y * dy, self._lat0 + self._lat_x * dx + self._lat_y * dy
+
+
+class VehicleStates:
+    """ Guided vehicles departing in the current step, with their positions.
+
+    Departed, parked and arrived ids arrive with the simulation step through
+    a simulation subscription; guided vehicles are recognized by id from a
+    precomputed set rather than by querying their type. A guided vehicle is
+    subscribed to its position once, when it departs (the subscription
+    response already carries the position), and unsubscribed when it starts
+    parking; SUMO drops subscriptions of arrived vehicles by itself. All
+    positions are then read from the subscription results of the step and
+    converted to geo coordinates locally.
+    """
+
+    def __init__(self, guided_ids, geo_transform=None):
+        self._guided_ids = set(guided_ids)
+        self._tracked = set()
+        self.departed_guided = []
+        self._positions = {}
+
+        traci.simulation.subscribe((tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_PARKING_STARTING_VEHICLES_IDS, tc.VAR_ARRIVED_VEHICLES_IDS))
+        self._geo_transform = geo_transform or GeoTransform.from_simulation()
+
+
+    def update(self):
+        events = traci.simulation.getSubscriptionResults()
+        departed = events.get(tc.VAR_DEPARTED_VEHICLES_IDS, ())
+        self.departed_guided = [vehicle for vehicle in departed if vehicle in self._guided_ids]
+
+        for vehicle in self.departed_guided:
+            traci.vehicle.subscribe(vehicle, (tc.VAR_POSITION,))
+            self._tracked.add(vehicle)
+        for vehicle in events.get(tc.VAR_PARKING_STARTING_VEHICLES_IDS, ()):
+            if vehicle in self._tracked:
+                traci.vehicle.unsubscribe(vehicle)
+                self._tracked.discard(vehicle)
+        self._tracked.difference_update(events.get(tc.VAR_ARRIVED_VEHICLES_IDS, ()))
+
+        self._positions = traci.vehicle.getAllSubscriptionResults()
+        return self.departed_guided
+
+
+    def geo_position(self, vehicle):
+        """ (lon, lat) of a guided vehicle which is on its way to parking. """
+        return self._geo_transform(*self._positions[vehicle][tc.VAR_POSITION])
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import zipfile
+import numpy as np
+from lxml import etree as ET
+
+
+from database import shared_database
+from routing import RoadGraph, WALKING
+from parking_registry import ParkingRegistry
+from constants import *
+
+
+buildings_file = os.path.join(sumo_rel_path, config_subdir, buildings_filename)
+parkings_file = os.path.join(sumo_rel_path, gen_subdir, parkings_gen_filename)
+walking_times_file = os.path.join(sumo_rel_path, gen_subdir, walking_times_gen_filename)
+
+
+class WalkingTimeMatrix:
+    """ Walking times between every building and every parking area, in seconds.
+
+    Walking costs are symmetric, so a single Dijkstra per building fills its row.
+    Unknown or unreachable pairs are stored as NaN and reported as None.
+    """
+
+    def __init__(self, buildings, parkings, times, fingerprint):
+        self._buildings = list(buildings)
+        self._parkings = list(parkings)
+        self._building_index = {building: i for i, building in enumerate(self._buildings)}
+        self._parking_index = {parking: i for i, parking in enumerate(self._parkings)}
+        self._times = np.asarray(times, dtype=np.float32)
+        self.fingerprint = fingerprint
+
+
+    @classmethod
+    def build(cls, router, buildings, parkings, fingerprint):
+        times = np.full((len(buildings), len(parkings)), np.nan, dtype=np.float32)
+        parking_vertices = [router.parking_vertex(parking) for parking in parkings]
+        target_vertices = {vertex for vertex in parking_vertices if vertex is not None}
+
+        for i, building in enumerate(buildings):
+            building_vertex = router.building_vertex(building)
+            if building_vertex is None:
+                continue
+
+            costs = router.costs_from(WALKING, building_vertex, target_vertices)
+            for j, parking_vertex in enumerate(parking_vertices):
+                if parking_vertex in costs:
+                    times[i, j] = round(costs[parking_vertex])
+
+        return cls(buildings, parkings, times, fingerprint)
+
+
+    @classmethod
+    def load(cls, path=walking_times_file):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['buildings'].tolist(), data['parkings'].tolist(), data['times'], str(data['fingerprint']))
+
+
+    def save(self, path=walking_times_file):
+        """ Writes matrix to a temporary file first, so concurrent readers never see a partial one. """
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as out:
+                np.savez_compressed(
+                    out,
+                    buildings=np.array(self._buildings, dtype=np.str_),
+                    parkings=np.array(self._parkings, dtype=np.str_),
+                    times=self._times,
+                    fingerprint=np.array(self.fingerprint)
+                )
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+    def walking_time(self, parking, building):
+        i = self._building_index.get(building)
+        j = self._parking_index.get(parking)
+        if i is None or j is None:
+            return None
+
+        time = self._times[i, j]
+        return None if np.isnan(time) else int(time)
+
+
+def read_buildings():
+    return [e.text for e in ET.parse(buildings_file).xpath('/buildings/building/name')]
+
+
+def read_parkings():
+    return ParkingRegistry.cached(parkings_file).ids
+
+
+def inputs_fingerprint(router):
+    """ Digest of everything the matrix depends on: both input files and the road graph. """
+    digest = hashlib.sha1()
+    for path in (buildings_file, parkings_file):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    digest.update(router.fingerprint().encode())
+    return digest.hexdigest()
+
+
+def load_walking_matrix(router, parkings=None, path=walking_times_file):
+    """ Loads stored matrix, rebuilding (and storing) it if it's missing or outdated. """
+    fingerprint = inputs_fingerprint(router)
+
+    if os.path.exists(path):
+        try:
+            matrix = WalkingTimeMatrix.load(path)
+            if matrix.fingerprint == fingerprint:
+                return matrix
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+            print(error)
+
+    matrix = WalkingTimeMatrix.build(router, read_buildings(), parkings if parkings is not None else read_parkings(), fingerprint)
+    matrix.save(path)
+    return matrix
+
+
+def main():
+    router = RoadGraph.load(shared_database())
+    matrix = WalkingTimeMatrix.build(router, read_buildings(), read_parkings(), inputs_fingerprint(router))
+    matrix.save()
+
+
+if __name__ == '__main__':
+    main()
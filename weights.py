@@ -0,0 +1,169 @@
+from bisect import bisect_left
+import os
+import threading
+import time
+import numpy as np
+from lxml import etree as ET
+
+
+from snapshot import load_snapshot, str_array
+from constants import *
+
+
+WEIGHT_NAMES = ['totalTime', 'walkingTime', 'probOfSuccess']
+
+
+class WeightConfigError(ValueError):
+    pass
+
+
+class FactorWeights:
+    """ Levels of a single factor: ascending upper thresholds and a levels x WEIGHT_NAMES matrix. """
+
+    __slots__ = ('thresholds', 'weights', '_threshold_list', '_weight_rows')
+
+    def __init__(self, thresholds, weights):
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self._threshold_list = self.thresholds.tolist()
+        self._weight_rows = [tuple(row) for row in self.weights.tolist()]
+
+
+    def lookup(self, value):
+        """ Weights of the first level whose upper threshold is >= value (values above all thresholds use the last level). """
+        level = min(bisect_left(self._threshold_list, value), len(self._threshold_list) - 1)
+        return self._weight_rows[level]
+
+
+    def lookup_many(self, values):
+        levels = np.minimum(np.searchsorted(self.thresholds, np.asarray(values, dtype=np.float64), side='left'), len(self.thresholds) - 1)
+        return self.weights[levels]
+
+
+def compile_weights(path):
+    """ Parses weights file into {factor id: FactorWeights}, raising WeightConfigError if it is malformed. """
+    try:
+        tree = ET.parse(path)
+    except (OSError, ET.XMLSyntaxError) as error:
+        raise WeightConfigError(f'cannot read {path}: {error}')
+
+    factors = {}
+    for factor_el in tree.xpath('/weights/factor'):
+        factor = factor_el.attrib.get('id')
+        if not factor:
+            raise WeightConfigError(f'{path}:{factor_el.sourceline}: factor without id')
+        if factor in factors:
+            raise WeightConfigError(f'{path}:{factor_el.sourceline}: duplicate factor "{factor}"')
+
+        levels = [_compile_level(path, factor, level_el) for level_el in factor_el.xpath('./level')]
+        if not levels:
+            raise WeightConfigError(f'{path}:{factor_el.sourceline}: factor "{factor}" has no levels')
+
+        levels.sort(key=lambda level: level[0])
+        thresholds = [threshold for threshold, _ in levels]
+        if len(set(thresholds)) != len(thresholds):
+            raise WeightConfigError(f'{path}: factor "{factor}" has levels with equal upperThreshold')
+
+        factors[factor] = FactorWeights(thresholds, [weights for _, weights in levels])
+
+    if not factors:
+        raise WeightConfigError(f'{path}: no factors defined')
+    return factors
+
+
+def _compile_level(path, factor, level_el):
+    where = f'{path}:{level_el.sourceline}: factor "{factor}"'
+    try:
+        threshold = float(level_el.attrib['upperThreshold'])
+    except (KeyError, ValueError):
+        raise WeightConfigError(f'{where}: level without numeric upperThreshold')
+
+    values = {}
+    for weight_el in level_el.xpath('./weight'):
+        name = weight_el.attrib.get('id')
+        if name not in WEIGHT_NAMES:
+            raise WeightConfigError(f'{where}: unknown weight "{name}"')
+        try:
+            values[name] = float(weight_el.attrib['value'])
+        except (KeyError, ValueError):
+            raise WeightConfigError(f'{where}: weight "{name}" without numeric value')
+
+    missing = [name for name in WEIGHT_NAMES if name not in values]
+    if missing:
+        raise WeightConfigError(f'{where}: level misses weights {missing}')
+
+    return threshold, [values[name] for name in WEIGHT_NAMES]
+
+
+def load_compiled_weights(path):
+    """ Same as `compile_weights`, but read from a snapshot while the file is unchanged. """
+    return load_snapshot('weights', [path], lambda: compile_weights(path), _factors_to_arrays, _factors_from_arrays)
+
+
+def _factors_to_arrays(factors):
+    names = list(factors)
+    return {
+        'factors': str_array(names),
+        'offsets': np.cumsum([0] + [len(factors[name].thresholds) for name in names]),
+        'thresholds': np.concatenate([factors[name].thresholds for name in names]),
+        'weights': np.concatenate([factors[name].weights for name in names])
+    }
+
+
+def _factors_from_arrays(arrays):
+    offsets = arrays['offsets'].tolist()
+    return {
+        name: FactorWeights(arrays['thresholds'][start:end], arrays['weights'][start:end])
+        for name, start, end in zip(arrays['factors'].tolist(), offsets, offsets[1:])
+    }
+
+
+class WeightTable:
+    """ Compiled weights.xml with O(log levels) lookup.
+
+    The file is recompiled when its modification time changes (checked at most
+    every `reload_interval` seconds); a malformed new version is reported and
+    the previous tables are kept.
+    """
+
+    def __init__(self, path, reload_interval=WEIGHTS_RELOAD_INTERVAL_SEC):
+        self._path = path
+        self._reload_interval = reload_interval
+        self._lock = threading.Lock()
+
+        self._mtime = os.path.getmtime(path)
+        self._factors = load_compiled_weights(path)
+        self._next_check = time.monotonic() + reload_interval
+
+
+    def weights(self, factor, value):
+        """ (totalTime, walkingTime, probOfSuccess) weights of factor at given value. """
+        return self._factor(factor).lookup(value)
+
+
+    def weights_many(self, factor, values):
+        """ Array of shape (len(values), len(WEIGHT_NAMES)) with weights for every value. """
+        return self._factor(factor).lookup_many(values)
+
+
+    def reload_if_changed(self):
+        with self._lock:
+            self._next_check = time.monotonic() + self._reload_interval
+            try:
+                mtime = os.path.getmtime(self._path)
+                if mtime == self._mtime:
+                    return
+                self._factors = load_compiled_weights(self._path)
+                self._mtime = mtime
+            except (OSError, WeightConfigError) as error:
+                print(f'Keeping previous weights: {error}')
+
+
+    def _factor(self, factor):
+        if time.monotonic() >= self._next_check:
+            self.reload_if_changed()
+
+        try:
+            return self._factors[factor]
+        except KeyError:
+            raise WeightConfigError(f'{self._path}: no weights defined for factor "{factor}"')
@@ -0,0 +1,91 @@
+import threading
+import time
+
+
+class WriteBehindQueue:
+    """ Records queued by callers and passed in batches to `write` by a background thread.
+
+    A batch is written once `batch_size` records are pending or the oldest
+    one has waited `flush_interval` seconds, and on `flush` or `close`.
+    `write` runs in one thread at a time, so it needs no locking of its own.
+    """
+
+    def __init__(self, write, name, batch_size, flush_interval):
+        self._write = write
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+
+        self._pending = []
+        self._oldest_pending = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+
+    def put(self, record):
+        with self._cond:
+            was_empty = not self._pending
+            if was_empty:
+                self._oldest_pending = time.monotonic()
+            self._pending.append(record)
+            # Idle writer waits without timeout, so it has to learn when the flush interval starts.
+            if was_empty or len(self._pending) >= self._batch_size:
+                self._cond.notify()
+
+
+    def flush(self):
+        """ Writes all pending records synchronously. """
+        batch = self._take_batch()
+        try:
+            if batch:
+                self._write(batch)
+        finally:
+            self._write_lock.release()
+
+
+    def discard(self):
+        """ Drops pending records and waits for the write in progress, if any. """
+        with self._cond:
+            self._pending = []
+            with self._write_lock:
+                pass
+
+
+    def close(self):
+        """ Stops the background thread after it has written everything still pending. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    self._cond.wait(self._time_to_due())
+                closing = self._closed
+
+            self.flush()
+            if closing:
+                return
+
+
+    def _due(self):
+        return len(self._pending) >= self._batch_size \
+            or (self._pending and time.monotonic() - self._oldest_pending >= self._flush_interval)
+
+
+    def _time_to_due(self):
+        return max(self._flush_interval - (time.monotonic() - self._oldest_pending), 0.) if self._pending else None
+
+
+    def _take_batch(self):
+        """ Empties the queue and returns its content, holding write lock (to be released by the caller). """
+        with self._cond:
+            batch, self._pending = self._pending, []
+            self._write_lock.acquire()
+        return batch
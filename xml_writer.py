@@ -0,0 +1,71 @@
+import os
+from lxml import etree as ET
+
+
+class XmlWriter:
+    """ Writes XML document one top-level element at a time.
+
+    Output looks like the one of minidom's toprettyxml used before: declaration
+    with double quotes and encoding, blank line, then elements indented with
+    tabs. Only the element being written has to be kept in memory, so the
+    size of the document is not bounded by RAM. The document goes to a
+    temporary file which replaces `path` once it is complete, so a file can
+    be rewritten while it is still being read.
+
+        with XmlWriter(path, 'additional') as out:
+            for parking in parkings:
+                out.write(parking)
+    """
+
+    def __init__(self, path, root_tag, attrib=None, nsmap=None, encoding='UTF-8'):
+        self._path = path
+        self._root_tag = root_tag
+        self._attrib = dict(attrib or {})
+        self._nsmap = nsmap
+        self._encoding = encoding
+
+
+    def __enter__(self):
+        self._tmp_path = f'{self._path}.{os.getpid()}.tmp'
+        self._file = open(self._tmp_path, 'wb')
+        try:
+            self._file.write(f'<?xml version="1.0" encoding="{self._encoding}"?>\n\n'.encode(self._encoding))
+            self._xmlfile = ET.xmlfile(self._file, encoding=self._encoding)
+            self._xf = self._xmlfile.__enter__()
+            self._root = self._xf.element(self._root_tag, self._attrib, nsmap=self._nsmap)
+            self._root.__enter__()
+            self._xf.write('\n')
+        except Exception:
+            self._file.close()
+            os.remove(self._tmp_path)
+            raise
+        return self
+
+
+    def write(self, element):
+        """ Writes element (with its subtree, but without its tail) as a child of the root. """
+        element.tail = None
+        if isinstance(element.tag, str):
+            ET.indent(element, space='\t', level=1)
+        self._xf.write('\t', element, '\n', with_tail=False)
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._file.close()
+            os.remove(self._tmp_path)
+            return False
+
+        try:
+            self._root.__exit__(None, None, None)
+            self._xmlfile.__exit__(None, None, None)
+            self._file.write(b'\n')
+            self._file.close()
+            os.replace(self._tmp_path, self._path)
+        except Exception:
+            self._file.close()
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+            raise
+        return False
+